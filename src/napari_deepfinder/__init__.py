@@ -2,10 +2,12 @@ __version__ = "0.0.1"
 
 from ._cluster_widget import ClusterWidget
 from ._orthoview_widget import Orthoslice
+from ._picking_widget import PickingWidget
 from ._reader import napari_get_reader
 from ._segmentation_widget import SegmentationWidget
 from ._widget import AddPointsWidget, denoise_widget, reorder_widget
 from ._writer import write_annotations_xml
+from ._writer import write_annotations_npz
 from ._writer import write_labelmap
 from ._writer import write_tomogram
 
@@ -13,12 +15,14 @@ from ._writer import write_tomogram
 __all__ = (
     "napari_get_reader",
     "write_annotations_xml",
+    "write_annotations_npz",
     "denoise_widget",
     "reorder_widget",
     "AddPointsWidget",
     "Orthoslice",
     "SegmentationWidget",
     "ClusterWidget",
+    "PickingWidget",
     "write_labelmap",
     "write_tomogram"
 )
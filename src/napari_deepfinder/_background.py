@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import napari
+from napari.qt.threading import create_worker
+from napari.utils import progress as progress_bar
+from napari.utils.notifications import show_info
+from qtpy.QtCore import QObject, Signal
+from ._multiscale import full_resolution
+from ._sparse import SparseLabelmap
+from ._writer import write_annotations_xml, write_annotations_npz, write_labelmap, write_tomogram
+
+# arrays bigger than this are snapshotted to a temporary file instead of memory
+max_snapshot_bytes = 1024 ** 3
+# number of voxels copied at once when snapshotting to a temporary file
+snapshot_slab_size = 64 * 1024 ** 2
+
+
+def save_annotations_xml(path: str, data: list):
+    """Writer for annotations in form of a xml object list, saving in the background"""
+    return save_in_background(write_annotations_xml, add_extension(path, '.xml'), data)
+
+
+def save_annotations_npz(path: str, data: list):
+    """Writer for annotations in form of a .npz object list, saving in the background"""
+    return save_in_background(write_annotations_npz, add_extension(path, '.npz'), data)
+
+
+def save_labelmap(path: str, data: np.ndarray, meta: dict):
+    """Writer for labelmaps (segmentation maps), saving in the background"""
+    return save_in_background(write_labelmap, add_extension(path, '.mrc', ('.zarr', '.npz')), data, meta)
+
+
+def save_tomogram(path: str, data: np.ndarray, meta: dict):
+    """Writer for tomograms, saving in the background"""
+    return save_in_background(write_tomogram, add_extension(path, '.mrc', ('.zarr',)), data, meta)
+
+
+def save_in_background(write, path: str, data, meta: dict = None):
+    """Save layer data with a writer of _writer without blocking napari.
+
+    The data is snapshotted first, so that the layer can still be edited while
+    it is written. The writer then runs on a worker thread, writing to a
+    temporary file next to path that is atomically renamed to path once
+    complete: path always holds either the previous file or the new one, and
+    the file a layer was read from can be overwritten safely. The progress is
+    shown in the napari activity dock.
+    Without a running viewer (e.g. from a script), the data is saved at once.
+
+    Parameters
+    ----------
+    write : callable
+        Writer of _writer, called as write(path, data, [meta,] progress=...).
+    path : str
+        Destination path, with its extension.
+    data : numpy.ndarray or list
+        Layer data, or list of LayerData tuples for the multiple layers writers.
+    meta : dict, optional
+        Layer attributes, for the single layer writers.
+
+    Returns
+    -------
+    str
+        path
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(os.path.abspath(path)))
+    tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+    try:
+        if isinstance(data, list) and meta is None:
+            args = ([(snapshot(layer_data, tmp_dir), dict(layer_meta), layer_type)
+                     for layer_data, layer_meta, layer_type in data],)
+        else:
+            args = (snapshot(data, tmp_dir), meta)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if napari.current_viewer() is None:
+        write_and_replace(write, tmp_path, path, args)
+        return path
+    pbar = progress_bar(total=100, desc='Saving %s' % os.path.basename(path))
+    signals = ProgressSignals()
+    signals.progressed.connect(lambda percent: pbar.update(percent - pbar.n))
+    worker = create_worker(write_and_replace, write, tmp_path, path, args, signals.progressed.emit)
+    worker.returned.connect(lambda _: show_info('Saved %s' % path))
+    worker.finished.connect(pbar.close)
+    # keep the signals alive as long as the worker
+    worker.progress_signals = signals
+    worker.start()
+    return path
+
+
+class ProgressSignals(QObject):
+    """Relay the progress of a worker thread (in percent) to the GUI thread"""
+    progressed = Signal(int)
+
+
+def write_and_replace(write, tmp_path: str, path: str, args: tuple, report=None):
+    """Write to tmp_path (in a temporary folder), then atomically replace path with it"""
+    tmp_dir = os.path.dirname(tmp_path)
+    try:
+        if report is None:
+            write(tmp_path, *args)
+        else:
+            write(tmp_path, *args, progress=lambda fraction: report(int(100 * fraction)))
+        if os.path.isdir(tmp_path) and os.path.isdir(path):
+            # a directory (zarr) cannot replace a non-empty one, move the old one away first
+            os.replace(path, os.path.join(tmp_dir, '.previous'))
+        os.replace(tmp_path, path)
+        if report is not None:
+            report(100)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return path
+
+
+def snapshot(data, tmp_dir: str):
+    """Copy of layer data that is not affected by later edits of the layer.
+
+    Compressed labelmaps share their immutable blocks with the copy, and dask
+    and read-only arrays are returned as is. Arrays bigger than
+    max_snapshot_bytes are copied slab by slab to a memory-mapped file of
+    tmp_dir. Multiscale data is saved at full resolution.
+    """
+    data = full_resolution(data)
+    if isinstance(data, SparseLabelmap):
+        return data.copy()
+    if not isinstance(data, np.ndarray) or not data.flags.writeable:
+        return data
+    if data.nbytes <= max_snapshot_bytes:
+        return data.copy()
+    # one file per array, as the layers of a multiple layers writer share tmp_dir
+    fd, snapshot_path = tempfile.mkstemp(prefix='snapshot', suffix='.npy', dir=tmp_dir)
+    os.close(fd)
+    copy = np.lib.format.open_memmap(snapshot_path, mode='w+', dtype=data.dtype, shape=data.shape)
+    # copy along the slowest axis in memory (the reader returns transposed views)
+    axis = int(np.argmax(np.abs(data.strides)))
+    step = max(snapshot_slab_size // max(data.size // data.shape[axis], 1), 1)
+    for start in range(0, data.shape[axis], step):
+        slab = (slice(None),) * axis + (slice(start, start + step),)
+        copy[slab] = data[slab]
+    copy.flush()
+    return copy
+
+
+def add_extension(path: str, extension: str, other_extensions: tuple = ()):
+    """Add the default extension of a writer to a path that has none of its extensions"""
+    if path.endswith(other_extensions + (extension,)):
+        return path
+    return path + extension
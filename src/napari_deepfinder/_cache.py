@@ -0,0 +1,105 @@
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+import numpy as np
+from ._sparse import SparseLabelmap
+
+# maximum size of the decoded data kept in memory by layer_cache
+max_cache_bytes = 2 * 1024 ** 3
+
+
+class LayerDataCache:
+    """LRU cache of the layer data decoded from files, with byte-size-based eviction.
+
+    Entries are keyed by the file path, modification time and size (plus the
+    reading options), so a modified file is decoded again. Only in-memory arrays
+    are cached: memory-mapped and dask arrays are backed by files.
+    The cache is shared by the reader and the widgets, see layer_cache.
+
+    napari edits labels and points data in place, so the layers must not share
+    the cached arrays. Labels are cached as SparseLabelmap, whose copies share
+    the compressed blocks until they are painted (copy on write), so a cache hit
+    copies no voxel. Points arrays are copied on each hit, which is cheap next
+    to decoding an object list (24 bytes per point). Dense in-memory labels
+    would have to be copied in full, so they are not cached (the reader keeps
+    in-memory labels sparse).
+    """
+
+    def __init__(self, max_bytes: int = max_cache_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        # the reader decodes files on several threads
+        self._lock = threading.Lock()
+
+    def get(self, path: str, **options):
+        """Return the cached list of LayerData tuples of a file, or None.
+
+        Labels and points data are returned as copies, since napari edits them
+        in place (painting, moving points) and the cache must keep the file
+        content, see copy_editable.
+        """
+        key = file_key(path, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        layer_data, _ = entry
+        return [(copy_editable(data, layer_type), dict(add_kwargs), layer_type)
+                for data, add_kwargs, layer_type in layer_data]
+
+    def put(self, path: str, layer_data: list, **options):
+        """Store the list of LayerData tuples of a file, evicting the least recently used ones"""
+        key = file_key(path, options)
+        nbytes = sum(data_nbytes(layer[0]) for layer in layer_data)
+        # file-backed data is cheap to open again, and must not be shared between layers
+        if nbytes == 0 or nbytes > self.max_bytes:
+            return
+        # dense labels would be copied in full on each hit
+        if any(layer_type == 'labels' and isinstance(data, np.ndarray) for data, _, layer_type in layer_data):
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (layer_data, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+def file_key(path: str, options: dict):
+    """Key identifying a given version of a file read with given options"""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, tuple(sorted(options.items())))
+
+
+def data_nbytes(data):
+    """Memory used by layer data, multiscale data being a sequence of arrays"""
+    if isinstance(data, Sequence):
+        return sum(data_nbytes(level) for level in data)
+    if isinstance(data, SparseLabelmap) or (isinstance(data, np.ndarray) and not isinstance(data, np.memmap)):
+        return data.nbytes
+    return 0
+
+
+def copy_editable(data, layer_type: str):
+    """Copy of the labels and points data, edited in place by napari.
+
+    SparseLabelmap copies share the compressed blocks, painting a copy replaces
+    its own blocks only.
+    """
+    if layer_type in ('labels', 'points') and isinstance(data, (np.ndarray, SparseLabelmap)):
+        return data.copy()
+    return data
+
+
+# cache shared by the reader and the widgets
+layer_cache = LayerDataCache()
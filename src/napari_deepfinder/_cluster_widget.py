@@ -1,13 +1,18 @@
-from qtpy.QtWidgets import QWidget, QGridLayout, QComboBox, QPushButton, QLabel, QGroupBox, QVBoxLayout, QTextEdit, \
+from qtpy.QtWidgets import QWidget, QGridLayout, QPushButton, QLabel, QGroupBox, QVBoxLayout, QTextEdit, \
     QSpinBox, QFileDialog, QLineEdit
 from qtpy import QtCore
 import numpy as np
+from pathlib import Path
 import napari
 import napari.layers
 from napari.qt.threading import create_worker
 from deepfinder.inference import Cluster
 from deepfinder.utils import core
 from deepfinder.utils import objl as ol
+from ._cache import layer_cache
+from ._layer_model import LayerComboBox
+from ._multiscale import full_resolution
+from ._reader import points_layer_data
 
 
 class ClusterWidget(QWidget):
@@ -21,13 +26,10 @@ class ClusterWidget(QWidget):
 
         self.print_signal.connect(self.on_print_signal)
 
-        # Use this event because of bug in viewer.events.layers_change.connect() : it doesn't register name change
-        napari_viewer.layers.events.connect(self._on_layer_change)
-
         self.setLayout(QVBoxLayout())
         # Input group
         self.group_input = QGroupBox('Input')
-        self._input_layer_box = QComboBox()
+        self._input_layer_box = LayerComboBox(napari_viewer, napari.layers.Labels)
         self.box_input = QGridLayout()
         # Label layer
         self.box_input.addWidget(QLabel('Labels layer:'), 0, 0, QtCore.Qt.AlignTop)
@@ -66,9 +68,6 @@ class ClusterWidget(QWidget):
         self.te_terminal_out.setVisible(False)
         self.te_terminal_out.setReadOnly(True)
         self.layout().addWidget(self.te_terminal_out, QtCore.Qt.AlignTop)
-        self._on_layer_change()
-
-        self._on_layer_change()
 
     def browse_output(self):
         """Callback called when the browse output button is clicked"""
@@ -85,20 +84,6 @@ class ClusterWidget(QWidget):
     def on_print_signal(self, message):  # is called when signal is emmited. Signal passes str 'message' to slot
         self.te_terminal_out.append(message)
 
-    def _on_layer_change(self, event=None):
-        current_text = self._input_layer_box.currentText()
-        self._input_layer_box.clear()
-        is_current_item_still_here = False
-        for layer in self.viewer.layers:
-            if isinstance(layer, napari.layers.labels.labels.Labels):
-                if layer.name == current_text:
-                    is_current_item_still_here = True
-                self._input_layer_box.addItem(layer.name)
-        if is_current_item_still_here:
-            self._input_layer_box.setCurrentText(current_text)
-        else:
-            self._input_layer_box.setCurrentIndex(-1)
-
     def launch_process(self):
         # Get parameters from line edit widgets:
         cradius = int(self.cluster_radius.value())
@@ -110,10 +95,9 @@ class ClusterWidget(QWidget):
         clust.sizeThr = csize_thr
         clust.set_observer(core.observer_gui(self.print_signal))
 
-        # Load label map:
+        # Load label map (the full resolution of multiscale labels):
         clust.display('Loading label map ...')
-        current_layer_text = self._input_layer_box.currentText()
-        labelmap_not_converted = self.viewer.layers[current_layer_text].data
+        labelmap_not_converted = full_resolution(self._input_layer_box.current_layer().data)
         # invert axes from z,y,x to x,y,z (weird convention)
         labelmap = np.transpose(labelmap_not_converted, (2, 1, 0))
 
@@ -122,6 +106,14 @@ class ClusterWidget(QWidget):
 
         # Save objlist:
         ol.write(self.objlist, path_objl)
+        # Put the layers in the cache, so that opening the objlist does not parse it again
+        if path_objl.endswith('.xml'):
+            class_labels = np.array([int(obj['label']) for obj in self.objlist], dtype=np.int64)
+            # same rounding as the '%.3f' format of the xml file
+            coords = np.array([[float('%.3f' % obj[axis]) for axis in 'xyz'] for obj in self.objlist],
+                              dtype=np.float64).reshape(-1, 3)
+            layer_data = points_layer_data(Path(path_objl).stem, class_labels, coords)
+            layer_cache.put(path_objl, layer_data, lazy=True, multiscale=True)
         return path_objl
 
     def add_cluster(self, path):
@@ -129,11 +121,7 @@ class ClusterWidget(QWidget):
         self._launch_clustering.setEnabled(True)
 
     def _run(self):
-        # save against edge cases where the name of the layer is modified and the add button is clicked just after
-        old_text = self._input_layer_box.currentText()
-        self._on_layer_change()
-        current_layer_text = self._input_layer_box.currentText()
-        if current_layer_text is not None and current_layer_text != "" and old_text == current_layer_text:
+        if self._input_layer_box.current_layer() is not None:
             self.te_terminal_out.setVisible(True)
             self._launch_clustering.setEnabled(False)
             worker = create_worker(self.launch_process)
@@ -0,0 +1,501 @@
+import itertools
+import os
+import tempfile
+import weakref
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.fft
+from scipy.ndimage import uniform_filter, uniform_filter1d
+from ._multiscale import full_resolution
+
+# maximum number of threads used to filter a volume
+max_denoise_threads = os.cpu_count() or 1
+# engines of denoise: exact scipy filter, constant-time box sums on a cached summed volume table,
+# or low-pass filters applied to a cached spectrum
+denoise_engines = ['exact', 'summed volume table', 'gaussian low-pass (fft)', 'butterworth low-pass (fft)']
+# minimum padding of the summed volume tables, so that small filter size changes reuse the table
+min_table_padding = 8
+# number of voxels computed at once from a summed volume table
+table_slab_size = 16 * 1024 ** 2
+# order of the butterworth low-pass filter
+butterworth_order = 4
+# size of the blocks of the chunked low-pass filter along each axis, halo excluded
+lowpass_block_size = 128
+# output dtypes of denoise, 'same' being the dtype of the image
+denoise_dtypes = ['same', 'float32', 'float16']
+
+
+def physical_memory():
+    """Size of the RAM, 8 GiB if it cannot be known"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024 ** 3
+
+
+# maximum memory allocated by denoise, beyond which it switches to chunked processing
+denoise_memory_budget = physical_memory() // 2
+
+
+def denoise(image_layer, filter_size: int, engine: str = 'exact', dtype=None, output=None):
+    """Denoise the data of an image layer with the given engine (see denoise_engines).
+
+    The box filter engines average boxes of filter_size voxels. The low-pass
+    engines attenuate the frequencies above 1 / filter_size (in cycles per voxel).
+
+    Parameters
+    ----------
+    image_layer : napari.layers.Image
+    filter_size : int
+    engine : str
+        One of denoise_engines.
+    dtype : numpy.dtype, optional
+        Output dtype, the dtype of the image by default.
+    output : numpy.ndarray, optional
+        Array of the shape of the image and of dtype to write the result into,
+        e.g. the previous result, so that no new volume is allocated.
+
+    Returns
+    -------
+    numpy.ndarray
+        The denoised volume, output if given.
+    """
+    return run_steps(iter_denoise(image_layer, filter_size, engine, dtype, output))
+
+
+def iter_denoise(image_layer, filter_size: int, engine: str = 'exact', dtype=None, output=None):
+    """Generator version of denoise, yielding between the steps of the computation.
+
+    It is run by a napari generator worker, which can be cancelled at each
+    yield, and returns the denoised volume.
+    If the result and the tables of the engine need more than
+    denoise_memory_budget, the volume is processed in chunks: the result is
+    written to a memory-mapped temporary file, the summed volume table engine
+    falls back to the exact one, and the low-pass engines filter blocks.
+    Multiscale images are denoised at full resolution.
+    """
+    data = full_resolution(image_layer.data)
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+    if output is None:
+        needed = denoise_memory_needed(data, engine, dtype)
+        if needed > denoise_memory_budget:
+            output = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=data.shape)
+            if engine.endswith('low-pass (fft)'):
+                return (yield from iter_lowpass_chunked(data, filter_size, engine.split()[0], output))
+            engine = 'exact'
+        else:
+            output = np.empty(data.shape, dtype=dtype)
+    if engine == 'summed volume table':
+        table = get_summed_volume_table(image_layer, filter_size)
+        yield
+        return (yield from table.iter_uniform_filter(filter_size, output))
+    if engine.endswith('low-pass (fft)'):
+        spectrum = get_spectrum(image_layer)
+        yield
+        return (yield from spectrum.iter_lowpass(filter_size, engine.split()[0], output))
+    return (yield from iter_uniform_filter_parallel(data, filter_size, output=output))
+
+
+def denoise_memory_needed(data, engine: str, dtype):
+    """Memory allocated by an engine to denoise a volume: the result and the tables that are not cached yet"""
+    size = int(np.prod(data.shape))
+    needed = size * np.dtype(dtype).itemsize
+    if engine == 'summed volume table':
+        # float64 padded volume and table
+        needed += 2 * size * 8
+    elif engine.endswith('low-pass (fft)'):
+        # complex spectrum of half the volume, its filtered copy, and the inverse FFT
+        needed += 3 * size * max(np.dtype(data.dtype).itemsize, 4)
+    return needed
+
+
+def run_steps(steps):
+    """Run a generator of iter_denoise and friends to completion, and return its value"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def denoise_preview(data, filter_size: int, engine: str = 'exact', dtype=None):
+    """Lazy denoising of a volume, for a fast preview of the displayed slices.
+
+    Returns a DenoisedView, which only filters the regions napari reads to
+    display them: moving through the volume updates the preview, in any
+    viewer and along any axis (e.g. the views of the Orthoslice widget).
+    Multiscale data gives a list of views, one per level, each filtered with
+    the filter size divided by the downsampling of the level.
+
+    Parameters
+    ----------
+    data : array-like or sequence of array-like
+        Volume, possibly memory-mapped or dask, or multiscale levels.
+    filter_size : int
+    engine : str
+        One of denoise_engines.
+    dtype : numpy.dtype, optional
+        Output dtype, the dtype of data by default.
+
+    Returns
+    -------
+    DenoisedView or list of DenoisedView
+    """
+    if isinstance(data, Sequence):
+        full_shape = data[0].shape
+        return [DenoisedView(level, max(int(round(filter_size * level.shape[0] / full_shape[0])), 1), engine, dtype)
+                for level in data]
+    return DenoisedView(data, filter_size, engine, dtype)
+
+
+class DenoisedView:
+    """Array-like denoising the regions of a volume when they are indexed.
+
+    The requested region is read from the volume with a halo around it and
+    filtered on its own, so indexing a slice only reads the slices within the
+    filter halo of it. For the box filter engines, the result matches
+    uniform_filter up to the float rounding. The low-pass engines filter each
+    region with a halo of twice the filter size, like iter_lowpass_chunked.
+
+    Parameters
+    ----------
+    data : array-like
+    filter_size : int
+    engine : str
+        One of denoise_engines.
+    dtype : numpy.dtype, optional
+        Output dtype, the dtype of data by default.
+    """
+
+    def __init__(self, data, filter_size: int, engine: str = 'exact', dtype=None):
+        self.data = data
+        self.filter_size = filter_size
+        self.engine = engine
+        self.dtype = np.dtype(data.dtype if dtype is None else dtype)
+        self.shape = tuple(data.shape)
+        # the window of scipy extends by size // 2 before a voxel and less after it
+        self.halo = int(np.ceil(2 * filter_size)) if engine.endswith('low-pass (fft)') else filter_size // 2
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        region, local = self._region(key)
+        if any(stop <= start for start, stop in region):
+            return np.zeros(self.shape, dtype=self.dtype)[key]
+        source = tuple(slice(max(start - self.halo, 0), min(stop + self.halo, n))
+                       for (start, stop), n in zip(region, self.shape))
+        filtered = self._filter(np.asarray(self.data[source]))
+        filtered = filtered[tuple(slice(start - s.start, stop - s.start) for (start, stop), s in zip(region, source))]
+        return filtered[local]
+
+    def _filter(self, block: np.ndarray):
+        if self.engine.endswith('low-pass (fft)'):
+            spectrum = Spectrum(block)
+            return run_steps(spectrum.iter_lowpass(self.filter_size, self.engine.split()[0],
+                                                   np.empty(spectrum.shape, self.dtype)))
+        # scipy does not support float16
+        float16 = self.dtype == np.float16 or block.dtype == np.float16
+        filtered = uniform_filter(block.astype(np.float32) if float16 else block, size=self.filter_size,
+                                  output=np.float32 if float16 else self.dtype)
+        return cast_filtered(filtered, self.dtype)
+
+    def _region(self, key):
+        """Box [start, stop) along each axis covering a basic index, and the index relative to it"""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        region, local = [], []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                indices = range(*k.indices(n))
+                if len(indices) == 0:
+                    region.append((0, 0))
+                    local.append(slice(0, 0))
+                    continue
+                start, stop = min(indices[0], indices[-1]), max(indices[0], indices[-1]) + 1
+                first, last = indices[0] - start, indices[-1] - start
+                region.append((start, stop))
+                local.append(slice(first, last + 1 if indices.step > 0 else (last - 1 if last > 0 else None),
+                                   indices.step))
+            elif isinstance(k, (int, np.integer)):
+                if not -n <= k < n:
+                    raise IndexError('index %i is out of bounds for axis %i with size %i' % (k, axis, n))
+                region.append((k % n, k % n + 1))
+                local.append(0)
+            else:
+                raise IndexError('DenoisedView only supports integers and slices')
+        return region, tuple(local)
+
+
+def uniform_filter_parallel(data: np.ndarray, size: int, n_threads: int = None, output=None):
+    """Multi-threaded equivalent of scipy.ndimage.uniform_filter(data, size, output), see iter_uniform_filter_parallel"""
+    return run_steps(iter_uniform_filter_parallel(data, size, n_threads, output))
+
+
+def iter_uniform_filter_parallel(data: np.ndarray, size: int, n_threads: int = None, output=None):
+    """Multi-threaded equivalent of scipy.ndimage.uniform_filter(data, size, output), yielding after each axis.
+
+    Like scipy, the volume is filtered by successive 1D uniform filters along
+    each axis, the intermediate results being stored in the output. Each
+    1D pass is split in blocks along another axis and the blocks are filtered
+    on a thread pool (scipy releases the GIL). The blocks contain whole lines
+    along the filtered axis, so that no halo is needed and the running sums of
+    scipy start at the same voxels: the result is bit-identical to uniform_filter.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Volume to filter, possibly memory-mapped.
+    size : int
+        Size of the box filter along each axis.
+    n_threads : int, optional
+        Number of threads, max_denoise_threads by default.
+    output : numpy.ndarray, optional
+        Array to write the result into, a new one of the dtype of data by default.
+
+    Returns
+    -------
+    numpy.ndarray
+        Filtered volume.
+    """
+    n_threads = max_denoise_threads if n_threads is None else n_threads
+    if output is None:
+        output = np.empty(data.shape, dtype=data.dtype)
+    if size <= 1 or data.size == 0:
+        output[...] = data
+        return output
+    if output.dtype == np.float16 or data.dtype == np.float16:
+        return (yield from _iter_uniform_filter_slabs(data, size, n_threads, output))
+    source = data
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for axis in range(data.ndim):
+            if data.ndim == 1:
+                uniform_filter1d(source, size, axis, output)
+            else:
+                # split along the longest other axis, the lines along axis stay whole
+                split_axis = max((a for a in range(data.ndim) if a != axis), key=lambda a: data.shape[a])
+                bounds = np.linspace(0, data.shape[split_axis], min(n_threads, data.shape[split_axis]) + 1)
+                blocks = [(slice(None),) * split_axis + (slice(start, stop),)
+                          for start, stop in zip(bounds[:-1].astype(int), bounds[1:].astype(int))]
+                list(executor.map(lambda block: uniform_filter1d(source[block], size, axis, output[block]),
+                                  blocks))
+            source = output
+            yield
+    return output
+
+
+def _iter_uniform_filter_slabs(data: np.ndarray, size: int, n_threads: int, output: np.ndarray):
+    """Uniform filter for the dtypes scipy does not support (float16), computed in float32 by slabs along axis 0.
+
+    Each slab is filtered with a halo of size // 2 slices, so that only a slab
+    is converted to float32 at a time.
+    """
+    step = max(table_slab_size // max(output[0].size, 1), 1)
+    slabs = [(start, min(start + step, data.shape[0])) for start in range(0, data.shape[0], step)]
+
+    def filter_slab(slab):
+        source = slice(max(slab[0] - size // 2, 0), min(slab[1] + size // 2, data.shape[0]))
+        filtered = uniform_filter(np.asarray(data[source], dtype=np.float32), size=size)
+        output[slab[0]:slab[1]] = filtered[slab[0] - source.start:slab[1] - source.start]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i in range(0, len(slabs), n_threads):
+            list(executor.map(filter_slab, slabs[i:i + n_threads]))
+            yield
+    return output
+
+
+class SummedVolumeTable:
+    """Summed volume table (3D integral image) of a volume, to box-filter it with any size.
+
+    The table holds the cumulative sums along every axis of the volume padded by
+    reflection (scipy's 'reflect' mode, numpy's 'symmetric'), in float64. The
+    sum over any box is then given by 8 lookups (computed as one difference
+    along each axis), so that each filter size costs a constant number of
+    operations per voxel. The result matches
+    scipy.ndimage.uniform_filter up to the float rounding.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+    padding : int
+        Padding of the volume, filter sizes up to 2 * padding can be evaluated.
+    """
+
+    def __init__(self, data: np.ndarray, padding: int):
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.padding = padding
+        padded = np.pad(np.asarray(data, dtype=np.float64), padding, mode='symmetric')
+        # leading zeros, so that the sum of [lo, hi) is table[hi] - table[lo] along each axis
+        self.table = np.zeros([n + 1 for n in padded.shape])
+        self.table[(slice(1, None),) * data.ndim] = padded
+        for axis in range(data.ndim):
+            np.cumsum(self.table, axis=axis, out=self.table)
+
+    def uniform_filter(self, size: int, output=None):
+        """Box filter of the volume, in output or a new array of its dtype (rounded for integer dtypes)"""
+        return run_steps(self.iter_uniform_filter(size, output))
+
+    def iter_uniform_filter(self, size: int, output=None):
+        """Generator version of uniform_filter, yielding after each batch of slabs"""
+        if size // 2 > self.padding or size - size // 2 - 1 > self.padding:
+            raise ValueError('Filter size %i is too large for a padding of %i' % (size, self.padding))
+        if output is None:
+            output = np.empty(self.shape, dtype=self.dtype)
+        if output.size == 0:
+            return output
+        # the window of voxel i is [i - size // 2, i - size // 2 + size) as in scipy
+        low = self.padding - size // 2
+        step = max(table_slab_size // max(output[0].size, 1), 1)
+        slabs = [(start, min(start + step, self.shape[0])) for start in range(0, self.shape[0], step)]
+        with ThreadPoolExecutor(max_workers=max_denoise_threads) as executor:
+            for i in range(0, len(slabs), max_denoise_threads):
+                list(executor.map(lambda slab: self._box_mean(output, slab, low, size),
+                                  slabs[i:i + max_denoise_threads]))
+                yield
+        return output
+
+    def _box_mean(self, output: np.ndarray, slab: tuple, low: int, size: int):
+        # box sums of the slab, as differences of the table along one axis after the other
+        index = [slice(low + slab[0], low + slab[1] + size)] + [slice(low, low + n + size) for n in self.shape[1:]]
+        total = self.table[tuple(index)]
+        for axis, n in enumerate(output[slab[0]:slab[1]].shape):
+            upper = (slice(None),) * axis + (slice(size, size + n),)
+            lower = (slice(None),) * axis + (slice(0, n),)
+            total = total[upper] - total[lower]
+        total /= size ** len(self.shape)
+        output[slab[0]:slab[1]] = cast_filtered(total, output.dtype)
+
+
+class Spectrum:
+    """Real FFT of a volume, to low-pass filter it with any cutoff.
+
+    The forward FFT is computed once, so that each cutoff only costs the
+    multiplication by the filter and an inverse FFT. The FFT is periodic: the
+    opposite borders of the volume are smoothed together.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.shape = data.shape
+        self.dtype = data.dtype
+        # scipy.fft keeps single precision (complex64 spectrum for float32 volumes)
+        real_dtype = np.float32 if np.dtype(self.dtype).itemsize <= 4 else np.float64
+        self.spectrum = scipy.fft.rfftn(np.asarray(data, dtype=real_dtype), workers=max_denoise_threads)
+
+    def iter_lowpass(self, filter_size: float, kind: str = 'gaussian', output=None):
+        """Low-pass filter the volume with a cutoff of 1 / filter_size, yielding between the FFT steps.
+
+        The result is written to output, or to a new array of the dtype of the volume.
+        """
+        filtered_spectrum = self.spectrum * lowpass_filter(self.shape, filter_size, kind, self.spectrum.real.dtype)
+        yield
+        filtered = scipy.fft.irfftn(filtered_spectrum, s=self.shape, workers=max_denoise_threads)
+        del filtered_spectrum
+        yield
+        if output is None:
+            return cast_filtered(filtered, self.dtype)
+        output[...] = cast_filtered(filtered, output.dtype)
+        return output
+
+
+def lowpass_filter(shape: tuple, filter_size: float, kind: str = 'gaussian', dtype=np.float32):
+    """Radial low-pass filter of the real FFT of a volume of the given shape.
+
+    'gaussian' is exp(-f^2 / 2 fc^2) and 'butterworth' is 1 / sqrt(1 + (f / fc)^2n)
+    of order butterworth_order, f being the frequency in cycles per voxel and
+    fc = 1 / filter_size the cutoff frequency.
+    """
+    squared = np.zeros([1] * len(shape), dtype=dtype)
+    for axis, n in enumerate(shape):
+        frequencies = scipy.fft.rfftfreq(n) if axis == len(shape) - 1 else scipy.fft.fftfreq(n)
+        squared = squared + (frequencies.astype(dtype) * filter_size).reshape([-1 if a == axis else 1
+                                                                               for a in range(len(shape))]) ** 2
+    if kind == 'butterworth':
+        return 1 / np.sqrt(1 + squared ** butterworth_order)
+    return np.exp(-squared / 2)
+
+
+def iter_lowpass_chunked(data: np.ndarray, filter_size: float, kind: str = 'gaussian', output=None):
+    """Low-pass filter a volume larger than memory by blocks (overlap-save), yielding after each block.
+
+    Each block of lowpass_block_size voxels is filtered with a halo of twice
+    the filter size around it, which is then discarded, so that only one
+    padded block is in memory at a time. The output is a memory-mapped
+    temporary file by default. The result differs from Spectrum.iter_lowpass near the
+    borders of the volume, which are not smoothed together.
+    """
+    if output is None:
+        output = np.memmap(tempfile.TemporaryFile(), dtype=data.dtype, mode='w+', shape=data.shape)
+    halo = int(np.ceil(2 * filter_size))
+    for block_index in itertools.product(*[range(0, n, lowpass_block_size) for n in data.shape]):
+        block = tuple(slice(start, min(start + lowpass_block_size, n)) for start, n in zip(block_index, data.shape))
+        padded = tuple(slice(max(b.start - halo, 0), min(b.stop + halo, n)) for b, n in zip(block, data.shape))
+        spectrum = Spectrum(data[padded])
+        filtered = run_steps(spectrum.iter_lowpass(filter_size, kind, np.empty(spectrum.shape, output.dtype)))
+        output[block] = filtered[tuple(slice(b.start - p.start, b.stop - p.start) for b, p in zip(block, padded))]
+        yield
+    return output
+
+
+def cast_filtered(filtered: np.ndarray, dtype):
+    """Cast a filtered volume to dtype, rounding (and clipping) for integer dtypes"""
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(filtered.dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(filtered), info.min, info.max).astype(dtype)
+    return filtered.astype(dtype, copy=False)
+
+
+# summed volume table of each image layer, dropped when the layer data changes
+_summed_volume_tables = weakref.WeakKeyDictionary()
+
+
+# spectrum of each image layer, dropped when the layer data changes
+_spectra = weakref.WeakKeyDictionary()
+
+
+def get_summed_volume_table(image_layer, size: int):
+    """Summed volume table of an image layer, computed once and cached"""
+    table = _summed_volume_tables.get(image_layer)
+    if table is None or table.padding < size // 2 + 1:
+        # connected once, the same callback is not connected again
+        image_layer.events.data.connect(_drop_cached_tables)
+        table = SummedVolumeTable(full_resolution(image_layer.data), max(size // 2 + 1, min_table_padding))
+        _summed_volume_tables[image_layer] = table
+    return table
+
+
+def get_spectrum(image_layer):
+    """Spectrum of an image layer, computed once and cached"""
+    spectrum = _spectra.get(image_layer)
+    if spectrum is None:
+        image_layer.events.data.connect(_drop_cached_tables)
+        spectrum = Spectrum(full_resolution(image_layer.data))
+        _spectra[image_layer] = spectrum
+    return spectrum
+
+
+def _drop_cached_tables(event):
+    _summed_volume_tables.pop(event.source, None)
+    _spectra.pop(event.source, None)
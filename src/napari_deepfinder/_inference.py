@@ -0,0 +1,158 @@
+import os
+import time
+import numpy as np
+from ._multiscale import full_resolution
+
+# number of scoremap values processed at once when normalizing and converting the scoremaps
+scoremap_slab_size = 16 * 1024 ** 2
+
+
+def segment_streaming(segment, data, store_dir: str, progress=None):
+    """Segment a tomogram patch by patch as Segment.launch, with a bounded memory.
+
+    The patches are the same as the ones of Segment.launch and are visited in
+    the same order, but each patch is read from data and normalized on its
+    own (data can be memory-mapped), and its predictions are accumulated in a
+    memory-mapped scoremap store of store_dir instead of in memory. The memory
+    used is therefore a few patches whatever the size of the tomogram; the
+    store takes 2 bytes per voxel and class on disk.
+    The scoremaps are the ones of Segment.launch, up to the rounding of the
+    normalization statistics, which are computed slab by slab in float64.
+
+    Parameters
+    ----------
+    segment : deepfinder.inference.Segment
+    data : array-like
+        3D tomogram, in the axis order given to Segment.launch, or sequence of
+        levels for multiscale data (the full resolution is segmented).
+    store_dir : str
+        Folder of the scoremap store.
+    progress : callable, optional
+        Called with the fraction of the patches processed after each patch.
+
+    Returns
+    -------
+    numpy.memmap
+        float16 scoremaps with index order [z,y,x,class], as Segment.launch.
+    """
+    segment.check_attributes()
+    data = full_resolution(data)
+    if data.ndim != 3:
+        raise ValueError('Expected a 3D tomogram, got a %iD array' % data.ndim)
+    mean, std = volume_statistics(data)
+    shape = data.shape
+    pcrop = segment.pcrop
+    half = segment.P // 2
+    lcrop = half - pcrop
+    step = 2 * half + 1 - segment.poverlap
+    # patch centers of Segment.launch, in the coordinates of the zero-padded tomogram
+    centers = [patch_centers(n + 2 * pcrop, half, step) for n in shape]
+    n_patches = int(np.prod([len(c) for c in centers]))
+    segment.display('Data array is divided in ' + str(n_patches) + ' patches ...')
+
+    start = time.time()
+    scoremaps = np.lib.format.open_memmap(os.path.join(store_dir, 'scoremaps.npy'), mode='w+',
+                                          dtype=np.float16, shape=shape + (segment.Ncl,))
+    counts = np.lib.format.open_memmap(os.path.join(store_dir, 'counts.npy'), mode='w+', dtype=np.int8, shape=shape)
+    patch = np.zeros((segment.P,) * 3, dtype=np.float32)
+    patch_count = 0
+    for x in centers[0]:
+        for y in centers[1]:
+            for z in centers[2]:
+                patch_count += 1
+                segment.display('Segmenting patch ' + str(patch_count) + ' / ' + str(n_patches) + ' ...')
+                # the padding of Segment.launch is zero after normalization
+                src, dst = clip_box((x, y, z), half, half, pcrop, shape)
+                patch[:] = 0
+                patch[dst] = (np.asarray(data[src], dtype=np.float32) - mean) / std
+                pred = segment.net.predict(patch.reshape((1,) + patch.shape + (1,)), batch_size=1)
+                # the borders of the predictions are cropped, as well as what falls in the padding
+                region, crop = clip_box((x, y, z), lcrop, half, pcrop, shape)
+                scoremaps[region] = scoremaps[region] + np.float16(pred[0][crop])
+                counts[region] += 1
+                if progress is not None:
+                    progress(patch_count / n_patches)
+
+    # normalize the overlapping regions
+    for slab in slabs(scoremaps):
+        scoremaps[slab] = scoremaps[slab] / counts[slab][..., None]
+    scoremaps.flush()
+    segment.display("Model took %0.2f seconds to predict" % (time.time() - start))
+    return scoremaps
+
+
+def scoremaps_to_labelmap(scoremaps: np.ndarray, path: str, binned: bool = False):
+    """Labelmap of scoremaps (see deepfinder.utils.smap.to_labelmap), computed slab by slab.
+
+    Parameters
+    ----------
+    scoremaps : numpy.ndarray
+        Scoremaps with index order [z,y,x,class], e.g. a memory-mapped store.
+    path : str
+        .npy file the labelmap is memory-mapped to.
+    binned : bool
+        Subsample the scoremaps by averaging 2x2x2 tiles first, as
+        deepfinder.utils.smap.bin.
+
+    Returns
+    -------
+    numpy.memmap
+        int8 labelmap with index order [z,y,x].
+    """
+    shape = scoremaps.shape[:3]
+    if binned:
+        shape = tuple(-(-n // 2) for n in shape)
+    labelmap = np.lib.format.open_memmap(path, mode='w+', dtype=np.int8, shape=shape)
+    # even slabs, so that the binning tiles do not straddle two slabs
+    for slab in slabs(scoremaps, multiple=2):
+        scores = np.asarray(scoremaps[slab])
+        if binned:
+            # zero padding to even sizes, as skimage.measure.block_reduce
+            scores = np.pad(scores, [(0, n % 2) for n in scores.shape[:3]] + [(0, 0)])
+            a, b, c, n_classes = scores.shape
+            scores = scores.reshape(a // 2, 2, b // 2, 2, c // 2, 2, n_classes).mean(axis=(1, 3, 5))
+            slab = slice(slab.start // 2, slab.start // 2 + len(scores))
+        labelmap[slab] = np.argmax(scores, axis=3)
+    labelmap.flush()
+    return labelmap
+
+
+def volume_statistics(data):
+    """Mean and standard deviation of a volume, computed slab by slab"""
+    total, total_sq = 0., 0.
+    for slab in slabs(data):
+        values = np.asarray(data[slab], dtype=np.float64)
+        total += values.sum()
+        total_sq += np.square(values).sum()
+    mean = total / data.size
+    return mean, np.sqrt(max(total_sq / data.size - mean ** 2, 0))
+
+
+def patch_centers(n: int, half: int, step: int):
+    """Patch centers along an axis of length n (padded), as in Segment.launch"""
+    centers = list(range(half, n - half, step))
+    if not centers or centers[-1] < n - half:
+        centers.append(n - half)
+    return centers
+
+
+def clip_box(center, radius: int, half: int, pcrop: int, shape: tuple):
+    """Slices of the box of radius around a padded patch center, clipped to the unpadded volume.
+
+    Returns the slices in the volume, and the slices of the clipped box in the
+    patch of the given half size.
+    """
+    src, dst = [], []
+    for c, n in zip(center, shape):
+        low, high = c - radius - pcrop, c + radius - pcrop
+        clipped_low, clipped_high = max(low, 0), min(high, n)
+        src.append(slice(clipped_low, clipped_high))
+        dst.append(slice(half - radius + clipped_low - low, half - radius + clipped_high - low))
+    return tuple(src), tuple(dst)
+
+
+def slabs(data, multiple: int = 1):
+    """Slices of slabs along the first axis of about scoremap_slab_size values"""
+    plane_size = max(int(np.prod(data.shape[1:])), 1)
+    step = max(scoremap_slab_size // plane_size // multiple, 1) * multiple
+    return [slice(start, min(start + step, data.shape[0])) for start in range(0, data.shape[0], step)]
@@ -0,0 +1,197 @@
+import os
+import re
+import tempfile
+import warnings
+from collections import Counter
+import numpy as np
+import napari
+import napari.layers
+from ._background import write_and_replace
+from ._reader import read_objects
+from ._writer import write_annotations_xml, write_objects_xml
+
+# number of journal entries after which the journal is compacted into the object list
+compaction_interval = 10000
+
+
+class AnnotationJournal:
+    """Append-only journal of the annotations of the points layers of a viewer.
+
+    Each point added to or removed from a points layer named "_classNumber"
+    is appended as one line to the journal file (path + '.journal'), so
+    autosaving costs O(changes) instead of rewriting the whole object list.
+    The line formats are "+ class_label x y z" and "- class_label x y z".
+    Once compaction_interval entries were journaled (checked after each whole
+    event, e.g. both lines of a moved point), and when the journal is stopped,
+    the layers are compacted into the xml object list and the journal is emptied.
+    If napari stops without compacting, replay_journal recovers the
+    annotations from the object list and the journal.
+
+    Parameters
+    ----------
+    viewer : napari.Viewer
+    path : str
+        Path of the xml object list.
+    """
+
+    def __init__(self, viewer: napari.Viewer, path: str):
+        self.viewer = viewer
+        self.path = path if path[-4:] == '.xml' else path + '.xml'
+        self.journal_path = self.path + '.journal'
+        self.n_entries = 0
+        # coordinates and class label of the points of each journaled layer, as last journaled
+        self._points = {}
+        self._labels = {}
+        self._file = None
+
+    def start(self):
+        """Compact the layers into the object list and journal their changes.
+
+        Returns False (without starting) if a journal of a previous session was
+        found: it is then replayed into the object list, to be opened first.
+        """
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+            replay_journal(self.path)
+            warnings.warn('Unsaved annotations of a previous session were recovered in %s, '
+                          'open it before starting the autosave again' % self.path)
+            return False
+        self.compact()
+        self._file = open(self.journal_path, 'a')
+        for layer in self.viewer.layers:
+            # the points of the current layers were just compacted into the object list
+            self._connect_layer(layer, append=False)
+        self.viewer.layers.events.inserted.connect(self._on_layer_inserted)
+        self.viewer.layers.events.removed.connect(self._on_layer_removed)
+        return True
+
+    def stop(self):
+        """Stop journaling and compact the layers into the object list"""
+        self.viewer.layers.events.inserted.disconnect(self._on_layer_inserted)
+        self.viewer.layers.events.removed.disconnect(self._on_layer_removed)
+        for layer in list(self._points):
+            self._disconnect_layer(layer)
+        self._file.close()
+        self._file = None
+        self.compact()
+
+    def compact(self):
+        """Rewrite the object list from the layers and empty the journal.
+
+        The object list is written to a temporary file that atomically
+        replaces it, so a crash while compacting leaves the previous one.
+        """
+        annotation_layers = [(layer.data, {'name': layer.name}, 'points') for layer in self.viewer.layers
+                             if isinstance(layer, napari.layers.Points) and class_label(layer.name) is not None]
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % os.path.basename(self.path),
+                                   dir=os.path.dirname(os.path.abspath(self.path)))
+        write_and_replace(write_annotations_xml, os.path.join(tmp_dir, os.path.basename(self.path)), self.path,
+                          (annotation_layers,))
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+        else:
+            open(self.journal_path, 'w').close()
+        self.n_entries = 0
+
+    def _append(self, sign: str, label: int, points: np.ndarray):
+        if label is None or len(points) == 0:
+            return
+        # repr keeps the exact float coordinates
+        self._file.write(''.join('%s %i %r %r %r\n' % (sign, label, *point) for point in points.tolist()))
+        self._file.flush()
+        self.n_entries += len(points)
+
+    def _compact_if_needed(self):
+        # only called once a whole event was journaled, the object list would miss half of it otherwise
+        if self.n_entries >= compaction_interval:
+            self.compact()
+
+    def _connect_layer(self, layer, append=True):
+        if isinstance(layer, napari.layers.Points):
+            self._points[layer] = np.array(layer.data, dtype=np.float64).reshape(-1, 3)
+            self._labels[layer] = class_label(layer.name)
+            layer.events.data.connect(self._on_data)
+            layer.events.name.connect(self._on_name)
+            if append:
+                self._append('+', self._labels[layer], self._points[layer])
+
+    def _disconnect_layer(self, layer):
+        layer.events.data.disconnect(self._on_data)
+        layer.events.name.disconnect(self._on_name)
+        return self._labels.pop(layer), self._points.pop(layer)
+
+    def _on_layer_inserted(self, event):
+        self._connect_layer(event.value)
+        self._compact_if_needed()
+
+    def _on_layer_removed(self, event):
+        if event.value in self._points:
+            self._append('-', *self._disconnect_layer(event.value))
+            self._compact_if_needed()
+
+    def _on_name(self, event):
+        # the class is given by the name, so a renamed layer moves its points to another class
+        layer = event.source
+        self._append('-', *self._disconnect_layer(layer))
+        self._connect_layer(layer)
+        self._compact_if_needed()
+
+    def _on_data(self, event):
+        layer = event.source
+        action = str(event.action)
+        if action not in ('added', 'removed', 'changed'):
+            return
+        label = self._labels[layer]
+        old_points = self._points[layer]
+        new_points = np.asarray(event.value, dtype=np.float64).reshape(-1, 3)
+        indices = np.array(event.data_indices, dtype=int)
+        if action == 'added' and len(old_points) + len(indices) == len(new_points):
+            added = new_points[indices]
+            self._points[layer] = np.concatenate([old_points, added])
+            self._append('+', label, added)
+        elif action == 'removed' and len(old_points) - len(indices) == len(new_points):
+            self._append('-', label, old_points[indices])
+            self._points[layer] = np.delete(old_points, indices, axis=0)
+        elif action == 'changed' and len(old_points) == len(new_points):
+            moved = indices[np.any(old_points[indices] != new_points[indices], axis=1)]
+            self._append('-', label, old_points[moved])
+            self._append('+', label, new_points[moved])
+            old_points[moved] = new_points[moved]
+        else:
+            # the whole data was replaced
+            self._append('-', label, old_points)
+            self._append('+', label, new_points)
+            self._points[layer] = new_points.copy()
+        self._compact_if_needed()
+
+
+def class_label(name: str):
+    """Class label of a layer named "_classNumber", None for other layers"""
+    regex = re.search(r"(\d+)$", name)
+    return int(regex.group(0)) if regex is not None else None
+
+
+def replay_journal(path: str):
+    """Apply the journal of an object list to it, and empty the journal.
+
+    Points are matched on their coordinates truncated to integers, as they are
+    written in the object list.
+    """
+    journal_path = path + '.journal'
+    objects = Counter()
+    if os.path.exists(path):
+        class_labels, coords = read_objects(path)
+        objects.update(zip(class_labels.tolist(), *coords.astype(np.int64).T.tolist()))
+    with open(journal_path) as journal:
+        for line in journal:
+            sign, label, *point = line.split()
+            key = (int(label), *(int(float(c)) for c in point))
+            if sign == '+':
+                objects[key] += 1
+            elif objects[key] > 0:
+                objects[key] -= 1
+    labels = sorted({key[0] for key in objects})
+    points = [np.array([key[1:] for key, count in objects.items() if key[0] == label
+                        for _ in range(count)]).reshape(-1, 3) for label in labels]
+    write_objects_xml(path, points, labels)
+    open(journal_path, 'w').close()
@@ -0,0 +1,140 @@
+import weakref
+from qtpy.QtCore import QAbstractListModel, QModelIndex, Qt
+from qtpy.QtWidgets import QComboBox
+import napari
+
+# viewer -> {layer type: LayerListModel}, shared by the widgets of a viewer
+_layer_list_models = weakref.WeakKeyDictionary()
+
+
+class LayerListModel(QAbstractListModel):
+    """Qt model of the names of the layers of a given type of a viewer.
+
+    The model follows the layer list incrementally: it only updates the rows
+    that change when a layer is inserted, removed or renamed, and the order of
+    the rows when the layers are reordered, instead of rebuilding the whole
+    list on every layer list event. Use layer_list_model to get the model
+    shared by all the widgets of a viewer.
+
+    Parameters
+    ----------
+    viewer : napari.Viewer
+    layer_type : type
+        Type of the layers listed (e.g. napari.layers.Points).
+    """
+
+    def __init__(self, viewer: napari.Viewer, layer_type: type):
+        super().__init__()
+        self.layers = viewer.layers
+        self.layer_type = layer_type
+        # layers of layer_type, in the order of the layer list
+        self._layers = [layer for layer in self.layers if isinstance(layer, layer_type)]
+        for layer in self._layers:
+            layer.events.name.connect(self._on_name)
+        self.layers.events.inserted.connect(self._on_inserted)
+        self.layers.events.removed.connect(self._on_removed)
+        self.layers.events.reordered.connect(self._on_reordered)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._layers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._layers):
+            return None
+        layer = self._layers[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return layer.name
+        if role == Qt.UserRole:
+            return layer
+        return None
+
+    def layer(self, row: int):
+        """Layer shown at a row"""
+        return self._layers[row]
+
+    def _on_inserted(self, event):
+        layer = event.value
+        if not isinstance(layer, self.layer_type):
+            return
+        # number of listed layers below the inserted one
+        row = sum(isinstance(other, self.layer_type) for other in self.layers[:event.index])
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._layers.insert(row, layer)
+        self.endInsertRows()
+        layer.events.name.connect(self._on_name)
+
+    def _on_removed(self, event):
+        layer = event.value
+        if layer not in self._layers:
+            return
+        layer.events.name.disconnect(self._on_name)
+        row = self._layers.index(layer)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._layers[row]
+        self.endRemoveRows()
+
+    def _on_name(self, event):
+        index = self.index(self._layers.index(event.source))
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
+
+    def _on_reordered(self, event=None):
+        layers = [layer for layer in self.layers if isinstance(layer, self.layer_type)]
+        if layers == self._layers:
+            return
+        self.layoutAboutToBeChanged.emit()
+        rows = {id(layer): row for row, layer in enumerate(layers)}
+        old_indexes = self.persistentIndexList()
+        new_indexes = [self.index(rows[id(self._layers[index.row()])]) for index in old_indexes]
+        self._layers = layers
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+
+def layer_list_model(viewer: napari.Viewer, layer_type: type):
+    """LayerListModel of a viewer for a layer type, shared by all the widgets"""
+    models = _layer_list_models.setdefault(viewer, {})
+    if layer_type not in models:
+        models[layer_type] = LayerListModel(viewer, layer_type)
+    return models[layer_type]
+
+
+class LayerComboBox(QComboBox):
+    """Combo box of the names of the layers of a given type of a viewer.
+
+    The selected layer stays selected when the layers are inserted, renamed or
+    reordered. No layer is selected when the selected layer is removed, or
+    when the first layer is inserted, so that a layer is always chosen by the user.
+
+    Parameters
+    ----------
+    viewer : napari.Viewer
+    layer_type : type
+        Type of the layers listed (e.g. napari.layers.Points).
+    """
+
+    def __init__(self, viewer: napari.Viewer, layer_type: type):
+        super().__init__()
+        self.setModel(layer_list_model(viewer, layer_type))
+        self.setCurrentIndex(-1)
+        self._keep_selection = False
+        # connected after the handlers of QComboBox, that select a layer after these changes
+        self.model().rowsAboutToBeInserted.connect(self._before_insertion)
+        self.model().rowsAboutToBeRemoved.connect(self._before_removal)
+        self.model().rowsInserted.connect(self._restore_selection)
+        self.model().rowsRemoved.connect(self._restore_selection)
+
+    def current_layer(self):
+        """Selected layer, or None"""
+        if self.currentIndex() < 0:
+            return None
+        return self.model().layer(self.currentIndex())
+
+    def _before_insertion(self, parent, first, last):
+        self._keep_selection = self.currentIndex() >= 0
+
+    def _before_removal(self, parent, first, last):
+        self._keep_selection = self.currentIndex() >= 0 and not first <= self.currentIndex() <= last
+
+    def _restore_selection(self, parent, first, last):
+        if not self._keep_selection:
+            self.setCurrentIndex(-1)
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections.abc import Sequence
+from pathlib import Path
+import dask.array as da
+import numpy as np
+
+# downsampling factors of the pyramid levels, relative to full resolution
+pyramid_factors = [2, 4, 8]
+# volumes with fewer voxels than this are displayed at full resolution only
+min_pyramid_size = 512 ** 3
+# maximum number of voxels read at once when downsampling
+slab_size = 64 * 1024 ** 2
+# edge of the chunks the levels are computed from until they are cached
+chunk_size = 64
+cache_dir = Path.home() / '.cache' / 'napari-deepfinder' / 'pyramids'
+# maximum size of the cache on disk, the least recently used pyramids are deleted beyond it
+max_cache_bytes = 16 * 1024 ** 3
+
+# cache folder -> thread writing its levels
+_cache_threads = {}
+_cache_lock = threading.Lock()
+
+
+def full_resolution(data):
+    """Full resolution array of layer data.
+
+    Multiscale layer data is a sequence of levels (napari wraps it in a
+    MultiScaleData, which is neither a list nor a tuple), the first one
+    being the full resolution.
+    """
+    if isinstance(data, Sequence):
+        return data[0]
+    return data
+
+
+def get_pyramid(data: np.ndarray, path: str):
+    """Return the multiscale pyramid [data, data/2, data/4, data/8] of a volume.
+
+    Nothing is read from data here, so that opening a tomogram stays
+    immediate. The image is downsampled by averaging: the levels are lazy dask
+    arrays (only the chunks under the displayed slice are read) until a
+    background thread has stored them as .npy files in an on-disk cache,
+    keyed by the file path and modification time, from which they are
+    memory-mapped when the file is opened again.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Full resolution volume, possibly memory-mapped.
+    path : str
+        File the volume was read from, used as cache key.
+
+    Returns
+    -------
+    list of array-like
+        The pyramid levels, from the highest resolution to the lowest one.
+    """
+    n_levels = len(level_shapes(data.shape))
+    folder = cache_dir / cache_key(path)
+    level_paths = [folder / ('image_%i.npy' % factor) for factor in pyramid_factors[:n_levels]]
+    if all(level_path.exists() for level_path in level_paths):
+        # mark the pyramid as recently used
+        os.utime(folder)
+        return [data] + [np.load(level_path, mmap_mode='r') for level_path in level_paths]
+    start_cache_thread(data, folder, level_paths)
+    pyramid = [data]
+    level = da.from_array(data, chunks=chunk_size, name=False).astype(np.float32)
+    for _ in range(n_levels):
+        level = da.coarsen(np.mean, level, {axis: 2 for axis in range(data.ndim)}, trim_excess=True)
+        pyramid.append(level)
+    return pyramid
+
+
+def level_shapes(shape: tuple):
+    """Shapes of the downsampled levels of a volume"""
+    shapes = []
+    for _ in pyramid_factors:
+        if min(shape) < 2:
+            break
+        shape = tuple(n // 2 for n in shape)
+        shapes.append(shape)
+    return shapes
+
+
+def cache_key(path: str):
+    """Key identifying a given version of a file"""
+    stat = os.stat(path)
+    key = '%s:%i:%i' % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def start_cache_thread(data: np.ndarray, folder: Path, level_paths: list):
+    """Write the levels of a pyramid to the cache in a background thread, unless it is already done"""
+    with _cache_lock:
+        thread = _cache_threads.get(folder)
+        if thread is not None and thread.is_alive():
+            return thread
+        thread = threading.Thread(target=write_pyramid, args=(data, folder, level_paths), daemon=True)
+        _cache_threads[folder] = thread
+    thread.start()
+    return thread
+
+
+def write_pyramid(data: np.ndarray, folder: Path, level_paths: list):
+    """Write the downsampled levels of a volume to the cache, then evict the least recently used pyramids"""
+    try:
+        folder.mkdir(parents=True, exist_ok=True)
+        previous = data
+        for level_path in level_paths:
+            if not level_path.exists():
+                write_downsampled(previous, level_path)
+            previous = np.load(level_path, mmap_mode='r')
+    except OSError:
+        # the cache is only an optimization, e.g. the disk may be full
+        shutil.rmtree(folder, ignore_errors=True)
+        return
+    evict_cache(keep=folder)
+
+
+def evict_cache(keep: Path = None):
+    """Delete the least recently used pyramids until the cache is below max_cache_bytes"""
+    folders = []
+    for folder in cache_dir.iterdir():
+        try:
+            if folder.is_dir():
+                size = sum(file.stat().st_size for file in folder.iterdir())
+                folders.append((folder.stat().st_mtime, folder, size))
+        except FileNotFoundError:
+            # the folder is being written or evicted by another thread
+            continue
+    total = sum(size for _, _, size in folders)
+    for _, folder, size in sorted(folders, key=lambda entry: entry[0]):
+        if total <= max_cache_bytes:
+            break
+        if folder != keep:
+            # memory-mapped levels of an evicted pyramid stay readable on POSIX systems
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+
+
+def write_downsampled(data: np.ndarray, path: Path):
+    """Downsample a volume by 2 along every axis and save it to a .npy file.
+
+    The volume is read slab by slab along its slowest axis, so that
+    memory-mapped volumes are read sequentially and never fully loaded.
+    """
+    out_shape = tuple(n // 2 for n in data.shape)
+    tmp_path = path.with_suffix('.tmp.npy')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=out_shape)
+    # slowest axis of the data on disk (the reader returns transposed views)
+    axis = int(np.argmax(np.abs(data.strides)))
+    plane_size = max(data.size // data.shape[axis], 1)
+    step = max(slab_size // plane_size // 2, 1)
+    for start in range(0, out_shape[axis], step):
+        stop = min(start + step, out_shape[axis])
+        in_slice = [slice(0, 2 * n) for n in out_shape]
+        out_slice = [slice(None)] * data.ndim
+        in_slice[axis] = slice(2 * start, 2 * stop)
+        out_slice[axis] = slice(start, stop)
+        slab = np.asarray(data[tuple(in_slice)])
+        out[tuple(out_slice)] = downsample(slab)
+    out.flush()
+    del out
+    # only complete levels are renamed into the cache
+    os.replace(tmp_path, path)
+
+
+def downsample(block: np.ndarray):
+    """Downsample a block with even dimensions by 2 along every axis by averaging"""
+    binned_shape = []
+    for n in block.shape:
+        binned_shape += [n // 2, 2]
+    binned = block.reshape(binned_shape).astype(np.float32)
+    return binned.mean(axis=tuple(range(1, 2 * block.ndim, 2)))
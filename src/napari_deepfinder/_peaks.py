@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import maximum_filter, minimum_filter, uniform_filter
+from scipy.spatial import cKDTree
+from ._multiscale import full_resolution
+
+# maximum number of threads used to detect the peaks of a volume
+max_peak_threads = os.cpu_count() or 1
+# number of voxels of the slabs processed by each thread, halo excluded
+peak_slab_size = 16 * 1024 ** 2
+
+
+def find_peaks(data, min_distance: int, threshold: float = None, extremum: str = 'maximum', label: int = None,
+               n_threads: int = None):
+    """Positions of the local extrema of a volume, at least min_distance apart.
+
+    The local extrema of boxes of 2 * min_distance + 1 voxels are detected on
+    slabs of the volume in parallel (with a halo, so that the result does not
+    depend on the slabs). For images, the voxels of constant boxes are not
+    peaks, so that the flat background of e.g. a scoremap is not detected
+    as a whole. A non-maximum suppression then keeps the strongest of the
+    peaks closer than min_distance, e.g. on the rims of plateaus.
+    Only one slab per thread is in memory at once, so data can be memory-mapped.
+
+    Parameters
+    ----------
+    data : array-like
+        Image (tomogram or scoremap) or labelmap, or sequence of levels for
+        multiscale data (the full resolution is used).
+    min_distance : int
+        Minimum distance between two peaks, in voxels.
+    threshold : float, optional
+        Peaks must be above it (below for minima).
+    extremum : str
+        'maximum' or 'minimum', the extrema to detect.
+    label : int, optional
+        For labelmaps: the peaks are the centers of the blobs of this class,
+        i.e. the maxima of its density in boxes of 2 * min_distance + 1 voxels.
+    n_threads : int, optional
+        max_peak_threads by default.
+
+    Returns
+    -------
+    coords : numpy.ndarray
+        (N, 3) positions of the peaks, from the strongest to the weakest.
+    values : numpy.ndarray
+        Values of data at the peaks (densities for labelmaps).
+    """
+    data = full_resolution(data)
+    n_threads = max_peak_threads if n_threads is None else n_threads
+    size = 2 * min_distance + 1
+    sign = -1 if extremum == 'minimum' and label is None else 1
+    # the density of a labelmap needs another halo
+    halo = min_distance if label is None else 2 * min_distance
+    plane_size = max(int(np.prod(data.shape[1:])), 1)
+    step = max(min(peak_slab_size // plane_size, -(-data.shape[0] // n_threads)), 1)
+
+    def detect(start):
+        stop = min(start + step, data.shape[0])
+        low, high = max(start - halo, 0), min(stop + halo, data.shape[0])
+        chunk = np.asarray(data[low:high])
+        if label is not None:
+            chunk = uniform_filter((chunk == label).astype(np.float32), size, mode='constant')
+        else:
+            chunk = sign * chunk.astype(np.float32)
+        peaks = chunk == maximum_filter(chunk, size, mode='constant', cval=-np.inf)
+        if threshold is not None:
+            peaks &= chunk >= sign * threshold
+        if label is not None:
+            peaks &= chunk > 0
+        else:
+            peaks &= chunk > minimum_filter(chunk, size, mode='constant', cval=np.inf)
+        # the peaks of the halo belong to the neighbour slabs
+        peaks[:start - low] = False
+        peaks[stop - low:] = False
+        coords = np.argwhere(peaks)
+        values = chunk[peaks]
+        coords[:, 0] += low
+        return coords, values
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = list(executor.map(detect, range(0, data.shape[0], step)))
+    coords = np.concatenate([coords for coords, _ in results]).reshape(-1, data.ndim)
+    values = np.concatenate([values for _, values in results])
+    keep = non_maximum_suppression(coords, values, min_distance)
+    return coords[keep].astype(np.float64), sign * values[keep]
+
+
+def non_maximum_suppression(coords: np.ndarray, values: np.ndarray, min_distance: float):
+    """Indices of the peaks kept, from the strongest to the weakest, none being closer than min_distance"""
+    order = np.argsort(-values, kind='stable')
+    if min_distance <= 0 or len(coords) == 0:
+        return order
+    # the peaks closer than min_distance (strictly) to each peak
+    neighbours = cKDTree(coords).query_ball_point(coords, np.nextafter(min_distance, 0))
+    suppressed = np.zeros(len(coords), dtype=bool)
+    keep = []
+    for i in order:
+        if not suppressed[i]:
+            keep.append(i)
+            suppressed[neighbours[i]] = True
+    return np.array(keep, dtype=np.int64)
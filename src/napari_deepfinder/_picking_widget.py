@@ -0,0 +1,94 @@
+from qtpy.QtWidgets import QWidget, QGridLayout, QComboBox, QPushButton, QLabel, QGroupBox, QVBoxLayout, QSpinBox, \
+    QLineEdit
+from qtpy import QtCore
+from qtpy.QtGui import QDoubleValidator
+import napari
+import napari.layers
+import warnings
+from napari.qt.threading import create_worker
+from ._layer_model import LayerComboBox
+from ._peaks import find_peaks
+from ._reader import points_layer_kwargs
+from ._snap import snap_extrema
+
+
+class PickingWidget(QWidget):
+    """
+    Widget to pick candidate particles automatically, as the local extrema of a tomogram or scoremap,
+    or as the centers of the blobs of a class of a labelmap.
+    The candidates are added as a points layer named with the "_classNumber" convention, to be reviewed.
+    """
+    def __init__(self, napari_viewer: napari.Viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+
+        self.setLayout(QVBoxLayout())
+        # Input group
+        self.group_input = QGroupBox('Input')
+        self._input_layer_box = LayerComboBox(napari_viewer, (napari.layers.Image, napari.layers.Labels))
+        self.box_input = QGridLayout()
+        # Image or labels layer
+        self.box_input.addWidget(QLabel('Image or labels layer:'), 0, 0, QtCore.Qt.AlignTop)
+        self.box_input.addWidget(self._input_layer_box, 0, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Extremum (ignored for labels layers)
+        self.extremum = QComboBox()
+        self.extremum.addItems(snap_extrema)
+        self.extremum.setCurrentText('maximum')
+        self.box_input.addWidget(QLabel('Extremum:'), 1, 0, QtCore.Qt.AlignTop)
+        self.box_input.addWidget(self.extremum, 1, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Minimum distance between two candidates
+        self.min_distance = QSpinBox()
+        self.min_distance.setMinimum(1)
+        self.min_distance.setValue(5)
+        self.box_input.addWidget(QLabel('Minimum distance:'), 2, 0, QtCore.Qt.AlignTop)
+        self.box_input.addWidget(self.min_distance, 2, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Threshold, none if empty
+        self.threshold = QLineEdit()
+        self.threshold.setPlaceholderText('none')
+        validator = QDoubleValidator(self.threshold)
+        # '.' as decimal separator whatever the locale, as float
+        validator.setLocale(QtCore.QLocale.c())
+        self.threshold.setValidator(validator)
+        self.box_input.addWidget(QLabel('Threshold:'), 3, 0, QtCore.Qt.AlignTop)
+        self.box_input.addWidget(self.threshold, 3, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Class of the candidates, and class picked in labels layers
+        self.class_label = QSpinBox()
+        self.class_label.setMinimum(1)
+        self.box_input.addWidget(QLabel('Class number:'), 4, 0, QtCore.Qt.AlignTop)
+        self.box_input.addWidget(self.class_label, 4, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Set group
+        self.group_input.setLayout(self.box_input)
+        self.layout().addWidget(self.group_input)
+        # Launch
+        self._launch_picking = QPushButton("Launch")
+        self._launch_picking.clicked.connect(self._run)
+        self.layout().addWidget(self._launch_picking, QtCore.Qt.AlignTop)
+        self.layout().addStretch()
+
+    def launch_process(self, layer, min_distance, threshold, extremum, class_label):
+        label = class_label if isinstance(layer, napari.layers.Labels) else None
+        coords, _ = find_peaks(layer.data, min_distance, threshold, extremum, label)
+        return '%s_candidates_%i' % (layer.name, class_label), coords
+
+    def add_candidates(self, result):
+        name, coords = result
+        # displayed as the annotations opened by the reader
+        self.viewer.add_points(coords, ndim=3, **points_layer_kwargs(name))
+        self._launch_picking.setEnabled(True)
+
+    def _run(self):
+        layer = self._input_layer_box.current_layer()
+        if layer is not None:
+            threshold = None
+            if self.threshold.text() != "":
+                # the validator lets intermediate inputs through, e.g. '-' or '1e'
+                if not self.threshold.hasAcceptableInput():
+                    warnings.warn('The threshold %s is not a number' % self.threshold.text())
+                    return
+                threshold = float(self.threshold.text())
+            self._launch_picking.setEnabled(False)
+            worker = create_worker(self.launch_process, layer, self.min_distance.value(), threshold,
+                                   self.extremum.currentText(), self.class_label.value())
+            worker.returned.connect(self.add_candidates)
+            worker.errored.connect(lambda _: self._launch_picking.setEnabled(True))
+            worker.start()
@@ -0,0 +1,135 @@
+import weakref
+import numpy as np
+from scipy.spatial import cKDTree
+
+# the tree is rebuilt when more points than this fraction of its size were added, moved or removed
+rebuild_fraction = 0.25
+# ... and at least this number of points, below which the buffer is cheap to scan
+min_rebuild_size = 256
+
+# points layer -> PointsIndex
+_points_indexes = weakref.WeakKeyDictionary()
+
+
+class PointsIndex:
+    """Spatial index (KD-tree) of the points of a points layer.
+
+    The index is updated incrementally from the data events of the layer:
+    added and moved points go to a buffer scanned by brute force, and removed
+    or moved points are tombstoned in the tree. The tree is rebuilt once the
+    buffer and tombstones exceed rebuild_fraction of its size, so that
+    queries stay O(log n) on average. Use points_index to get the index of a
+    layer, kept up to date as the layer is edited.
+
+    Each point gets an id in the order it was added. Since napari appends the
+    added points at the end of the layer data, the ids of the layer points
+    stay sorted, which maps them back to layer indices.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (N, D) coordinates of the points.
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.rebuild(data)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def rebuild(self, data: np.ndarray):
+        """Index the coordinates of data from scratch"""
+        data = np.asarray(data, dtype=np.float64)
+        self.ndim = data.shape[1] if data.ndim == 2 else 3
+        self._coords = data.reshape(-1, self.ndim).copy()
+        # ids of the layer points, in the order of the layer data
+        self._ids = np.arange(len(self._coords))
+        self._tree = cKDTree(self._coords)
+        # whether the tree coordinates of an id are still those of the layer point
+        self._in_tree = np.ones(len(self._coords), dtype=bool)
+        self._n_tombstones = 0
+        # ids of the points that are not in the tree
+        self._buffer = set()
+
+    def query_radius(self, point, radius: float):
+        """Sorted layer indices of the points within radius of point"""
+        point = np.asarray(point, dtype=np.float64)
+        ids = np.array(self._tree.query_ball_point(point, radius), dtype=np.int64)
+        ids = ids[self._in_tree[ids]]
+        buffer_ids, distances = self._buffer_distances(point)
+        ids = np.concatenate([ids, buffer_ids[distances <= radius]])
+        return np.sort(np.searchsorted(self._ids, ids))
+
+    def nearest(self, point):
+        """Layer index of the nearest point and its distance, (None, inf) if there is no point"""
+        point = np.asarray(point, dtype=np.float64)
+        best_id, best_distance = None, np.inf
+        n_tree = self._tree.n
+        k = 1
+        while n_tree > 0:
+            # look further until a point that was not tombstoned is found
+            distances, ids = self._tree.query(point, k=min(k, n_tree))
+            distances, ids = np.atleast_1d(distances), np.atleast_1d(ids)
+            valid = self._in_tree[ids]
+            if valid.any():
+                best_id, best_distance = ids[valid][0], distances[valid][0]
+                break
+            if k >= n_tree:
+                break
+            k *= 2
+        buffer_ids, distances = self._buffer_distances(point)
+        if len(distances) > 0 and distances.min() < best_distance:
+            best_id, best_distance = buffer_ids[np.argmin(distances)], distances.min()
+        if best_id is None:
+            return None, np.inf
+        return int(np.searchsorted(self._ids, best_id)), float(best_distance)
+
+    def update(self, event):
+        """Update the index from a data event of the layer"""
+        action = str(event.action)
+        if action not in ('added', 'removed', 'changed'):
+            return
+        data = np.asarray(event.value, dtype=np.float64).reshape(-1, self.ndim)
+        indices = np.array(event.data_indices, dtype=np.int64)
+        if action == 'added' and len(self._ids) + len(indices) == len(data):
+            new_ids = np.arange(len(self._coords), len(self._coords) + len(indices))
+            self._coords = np.concatenate([self._coords, data[len(self._ids):]])
+            self._in_tree = np.concatenate([self._in_tree, np.zeros(len(indices), dtype=bool)])
+            self._ids = np.concatenate([self._ids, new_ids])
+            self._buffer.update(new_ids.tolist())
+        elif action == 'removed' and len(self._ids) - len(indices) == len(data):
+            self._remove_from_tree(self._ids[indices])
+            self._buffer.difference_update(self._ids[indices].tolist())
+            self._ids = np.delete(self._ids, indices)
+        elif action == 'changed' and len(self._ids) == len(data):
+            ids = self._ids[indices]
+            moved = np.any(self._coords[ids] != data[indices], axis=1)
+            self._remove_from_tree(ids[moved])
+            self._coords[ids[moved]] = data[indices[moved]]
+            self._buffer.update(ids[moved].tolist())
+        else:
+            # the whole data was replaced
+            self.rebuild(data)
+            return
+        if len(self._buffer) + self._n_tombstones > max(min_rebuild_size, rebuild_fraction * self._tree.n):
+            self.rebuild(self._coords[self._ids])
+
+    def _remove_from_tree(self, ids):
+        ids = ids[ids < self._tree.n]
+        self._n_tombstones += int(np.count_nonzero(self._in_tree[ids]))
+        self._in_tree[ids] = False
+
+    def _buffer_distances(self, point):
+        buffer_ids = np.fromiter(self._buffer, dtype=np.int64, count=len(self._buffer))
+        distances = np.linalg.norm(self._coords[buffer_ids] - point, axis=1)
+        return buffer_ids, distances
+
+
+def points_index(layer):
+    """PointsIndex of a points layer, built on first use and then updated as the layer is edited"""
+    index = _points_indexes.get(layer)
+    if index is None:
+        index = PointsIndex(layer.data)
+        _points_indexes[layer] = index
+        layer.events.data.connect(index.update)
+    return index
@@ -1,12 +1,35 @@
+import os
+import dask.array as da
+import h5py
+import mrcfile
 import numpy as np
 import pandas as pd
+import zarr
+from lxml import etree
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from mrcfile.utils import data_dtype_from_header, data_shape_from_header
 from deepfinder.utils.common import read_array
+from ._cache import layer_cache
+from ._multiscale import get_pyramid, min_pyramid_size
+from ._sparse import SparseLabelmap, is_sparse_labelmap_npz, load_sparse_labelmap
 
 # readable tomograms, see read_array function from deepfinder
 extensions_tomo = ['.mrc', '.map', '.rec', '.h5', '.tif', '.TIF']
+# tomograms that can be memory-mapped instead of loaded into RAM
+extensions_mrc = ['.mrc', '.map', '.rec']
+# chunked tomograms (directories), read lazily
+extensions_zarr = ['.zarr']
 extensions_labels = ['.xml', '.ods', '.xls', '.xlsx']
-extensions = extensions_tomo + extensions_labels
+# binary columnar object lists and compressed labelmaps, see write_annotations_npz and write_labelmap
+extensions_npz = ['.npz']
+extensions = extensions_tomo + extensions_zarr + extensions_labels + extensions_npz
+# maximum number of files decoded concurrently
+max_reader_threads = min(8, os.cpu_count() or 1)
+# approximate number of voxels read to compute the contrast limits
+contrast_sample_size = 10 ** 6
 
 
 def napari_get_reader(path):
@@ -31,18 +54,18 @@ def napari_get_reader(path):
     if isinstance(path, list):
         for single_file in path:
             # if we know we cannot read the file, we immediately return None.
-            if not single_file.endswith(tuple(extensions)):
+            if not is_readable(single_file):
                 return None
         return reader_function
     else:
         # if we know we cannot read the file, we immediately return None.
-        if not path.endswith(tuple(extensions)):
+        if not is_readable(path):
             return None
         # otherwise, we return the *function* that can read ``path``.
         return reader_function
 
 
-def reader_function(path):
+def reader_function(path, lazy=True, multiscale=True):
     """Take a path or list of paths and return a list of LayerData tuples.
 
     Readers are expected to return data as a list of tuples, where each tuple
@@ -53,6 +76,17 @@ def reader_function(path):
     ----------
     path : str or list of str
         Path to file, or list of paths.
+    lazy : bool
+        If True, MRC files are memory-mapped so that only the header is read
+        when opening, and slices are paged in from disk while browsing.
+    multiscale : bool
+        If True, large tomograms are returned as a multiscale layer with 2x, 4x
+        and 8x downsampled levels, computed lazily and cached on disk in the
+        background for later openings (see get_pyramid). Labelmaps stay
+        single-scale, as napari does not allow painting multiscale labels.
+
+    Several files are decoded concurrently, and their layers are returned in
+    the order of the paths.
 
     Returns
     -------
@@ -64,49 +98,313 @@ def reader_function(path):
         Both "meta", and "layer_type" are optional. napari will default to
         layer_type=="image" if not provided
     """
-    layer_data = []
     # handle both a string and a list of strings
     paths = [path] if isinstance(path, str) else path
-    for _path in paths:
-        if _path.endswith(tuple(extensions_tomo)):
-            # load all files into array
-            data = read_array(_path)
-            # invert axes from z,y,x to x,y,z (weird convention)
-            data = np.transpose(data, (2, 1, 0))
-            # if the data is the target value, import as labels layer
-            if data.dtype.name == 'int8':
-                # unique_labels = np.unique(data)
-                # optional kwargs for the corresponding viewer.add_* method
-                add_kwargs = {}
-                layer_type = "labels"  # optional, default is "image"
-            else:
-                # optional kwargs for the corresponding viewer.add_* method
-                add_kwargs = {}
-                layer_type = "image"  # optional, default is "image"
-            layer_data.append((data, add_kwargs, layer_type))
-        if _path.endswith(tuple(extensions_labels)):
-            name = Path(_path).stem
-            df = read_label(_path)
-            unq_label = df['class_label'].unique()
-            for i in range(len(unq_label)):
-                df_label = df.loc[df['class_label'] == unq_label[i]]
-                data = df_label[['x', 'y', 'z']].values
-                size = 10  # this default value could be changed for each label
-                color = 'white'  # this default value could be changed for each label
-                name_id = name + '_' + str(unq_label[i])
-                add_kwargs = {'out_of_slice_display': True,
-                              'size': size,
-                              'face_color': color,
-                              'name': name_id}
-                layer_type = "points"
-                layer_data.append((data, add_kwargs, layer_type))
+    read = partial(read_path, lazy=lazy, multiscale=multiscale)
+    if len(paths) == 1:
+        results = [read(paths[0])]
+    else:
+        # file reads and numpy/zarr decoding release the GIL, so threads overlap
+        with ThreadPoolExecutor(max_workers=min(len(paths), max_reader_threads)) as executor:
+            # map keeps the order of the paths
+            results = list(executor.map(read, paths))
+    return [layer for layers in results for layer in layers]
+
+
+def read_path(path, lazy=True, multiscale=True):
+    """Read a single file and return its list of LayerData tuples, see reader_function.
+
+    Files already decoded during the session are taken from layer_cache.
+    """
+    path = strip_path(path)
+    layer_data = layer_cache.get(path, lazy=lazy, multiscale=multiscale)
+    if layer_data is None:
+        layer_data = decode_path(path, lazy=lazy, multiscale=multiscale)
+        layer_cache.put(path, layer_data, lazy=lazy, multiscale=multiscale)
+        # the cached arrays must not be edited by the layers
+        layer_data = layer_cache.get(path, lazy=lazy, multiscale=multiscale) or layer_data
+    return layer_data
+
+
+def decode_path(path, lazy=True, multiscale=True):
+    """Decode a single file into a list of LayerData tuples"""
+    layer_data = []
+    if path.endswith(tuple(extensions_zarr)):
+        levels = read_zarr(path)
+        layer_type = "labels" if levels[0].dtype.name == 'int8' else "image"
+        if len(levels) > 1:
+            layer_data.append((levels, {'multiscale': True}, layer_type))
+        else:
+            layer_data.append((levels[0], {}, layer_type))
+    if path.endswith(tuple(extensions_tomo)):
+        # the layer type and metadata are known from the header, before decoding
+        header = probe_tomogram(path)
+        add_kwargs = {'metadata': {'voxel_size': header['voxel_size']}}
+        # if the data is the target value, import as labels layer
+        if header['dtype'].name == 'int8':
+            layer_type = "labels"  # optional, default is "image"
+        else:
+            layer_type = "image"  # optional, default is "image"
+        data = read_tomogram(path, lazy=lazy)
+        if layer_type == "labels" and not isinstance(data, np.memmap):
+            # labelmaps are mostly background, keep them compressed in memory
+            data = SparseLabelmap.from_dense(data)
+        if layer_type == "image":
+            # avoid a full pass of napari over the volume
+            add_kwargs['contrast_limits'] = sample_contrast_limits(data)
+        # napari makes multiscale labels read-only, so labelmaps stay single-scale to be painted
+        if layer_type == "image" and multiscale and isinstance(data, np.ndarray) and data.size >= min_pyramid_size:
+            data = get_pyramid(data, path)
+            add_kwargs['multiscale'] = True
+        layer_data.append((data, add_kwargs, layer_type))
+    if path.endswith(tuple(extensions_npz)) and is_sparse_labelmap_npz(path):
+        layer_data.append((load_sparse_labelmap(path), {}, "labels"))
+    elif path.endswith(tuple(extensions_labels + extensions_npz)):
+        features = {}
+        if path.endswith(".xml"):
+            class_labels, coords = read_objects(path)
+        elif path.endswith(tuple(extensions_npz)):
+            class_labels, coords, features['tomo_idx'] = read_objects_npz(path)
+        else:
+            df = read_label(path)
+            class_labels = df['class_label'].values
+            coords = df[['x', 'y', 'z']].values
+        layer_data += points_layer_data(Path(path).stem, class_labels, coords, features)
+    return layer_data
+
+
+def points_layer_data(name, class_labels, coords, features=None):
+    """Build one points LayerData tuple per class of an object list.
+
+    Parameters
+    ----------
+    name : str
+        Name of the object list, layers are named name_classLabel.
+    class_labels : numpy.ndarray
+        Class label of each object, of shape (n,).
+    coords : numpy.ndarray
+        x, y, z coordinates of each object, of shape (n, 3).
+    features : dict, optional
+        Columns of shape (n,) added as features of the points.
+    """
+    features = features or {}
+    layer_data = []
+    groups = group_by_class(class_labels, coords, *features.values())
+    for label, (data, *feature_values) in groups:
+        add_kwargs = points_layer_kwargs(name + '_' + str(label))
+        if features:
+            add_kwargs['features'] = dict(zip(features, feature_values))
+        layer_type = "points"
+        layer_data.append((data, add_kwargs, layer_type))
     return layer_data
 
 
+def points_layer_kwargs(name):
+    """Keyword arguments of the points layers of annotations, see napari.Viewer.add_points"""
+    size = 10  # this default value could be changed for each label
+    color = 'white'  # this default value could be changed for each label
+    return {'out_of_slice_display': True,
+            'size': size,
+            'face_color': color,
+            'name': name}
+
+
+def read_tomogram(filename, lazy=True):
+    """Read a tomogram and return it with axes in x,y,z order.
+
+    The axes are reordered as a view, so a memory-mapped volume stays
+    memory-mapped.
+    """
+    if lazy and filename.endswith(tuple(extensions_mrc)):
+        data = read_mrc_lazy(filename)
+    else:
+        # load all files into array
+        data = read_array(filename)
+    # invert axes from z,y,x to x,y,z (weird convention)
+    return np.transpose(data, (2, 1, 0))
+
+
+def probe_tomogram(filename):
+    """Read the dtype, shape and voxel size of a tomogram from its header only.
+
+    The dtype and shape are the ones of the array returned by read_tomogram
+    (axes in x,y,z order). The voxel size is None when the format has none.
+
+    Returns
+    -------
+    dict
+        'dtype' (numpy.dtype), 'shape' (tuple) and 'voxel_size' (tuple or None).
+    """
+    if filename.endswith(tuple(extensions_mrc)):
+        with mrcfile.open(filename, permissive=True, header_only=True) as mrc:
+            dtype = data_dtype_from_header(mrc.header)
+            shape = data_shape_from_header(mrc.header)
+            voxel_size = tuple(float(mrc.voxel_size[axis]) for axis in 'xyz')
+    elif filename.endswith('.h5'):
+        with h5py.File(filename, 'r') as h5file:
+            dataset = h5file['dataset']
+            dtype, shape, voxel_size = dataset.dtype, dataset.shape, None
+    else:
+        # read_array returns tif stacks as float32 arrays of transposed frames
+        with Image.open(filename) as tif:
+            width, height = tif.size
+            shape = (tif.n_frames, width, height)
+        dtype, voxel_size = np.dtype(np.float32), None
+    return {'dtype': np.dtype(dtype), 'shape': tuple(shape)[::-1], 'voxel_size': voxel_size}
+
+
+def sample_contrast_limits(data):
+    """Contrast limits computed on a strided subsample of contrast_sample_size voxels"""
+    step = max(int(np.ceil((data.size / contrast_sample_size) ** (1 / data.ndim))), 1)
+    sample = np.asarray(data[(slice(None, None, step),) * data.ndim])
+    low, high = float(np.nanmin(sample)), float(np.nanmax(sample))
+    if low == high:
+        high = low + 1
+    return [low, high]
+
+
+def read_mrc_lazy(filename):
+    """Memory-map the data block of a MRC file.
+
+    Only the header is read here. The map is copy-on-write, so layers built
+    on it (e.g. labels being painted) can be edited without touching the file.
+    """
+    with mrcfile.open(filename, permissive=True, header_only=True) as mrc:
+        header = mrc.header
+    dtype = data_dtype_from_header(header)
+    shape = data_shape_from_header(header)
+    # python int to avoid overflow of the int32 extended header size
+    offset = header.nbytes + int(header.nsymbt)
+    return np.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+
+
+def read_zarr(filename):
+    """Read a Zarr array or OME-Zarr image as lazy arrays with axes in x,y,z order.
+
+    The returned dask arrays are aligned on the Zarr chunks, so that only the
+    chunks of the displayed slices are read and decompressed.
+
+    Returns
+    -------
+    list of dask.array.Array
+        One array per resolution level, from the highest resolution to the lowest one.
+    """
+    root = zarr.open(filename, mode='r')
+    if isinstance(root, zarr.Array):
+        arrays = [root]
+    else:
+        attrs = root.attrs.asdict()
+        # OME-Zarr 0.5 nests its metadata in a 'ome' attribute
+        multiscales = attrs.get('ome', attrs).get('multiscales')
+        if multiscales is None:
+            raise ValueError('%s is neither a Zarr array nor an OME-Zarr image' % filename)
+        arrays = [root[dataset['path']] for dataset in multiscales[0]['datasets']]
+    levels = []
+    for array in arrays:
+        level = da.from_zarr(array)
+        # keep the spatial axes of t,c,z,y,x images
+        level = level[(0,) * (level.ndim - 3)]
+        # invert axes from z,y,x to x,y,z (weird convention)
+        levels.append(da.transpose(level, (2, 1, 0)))
+    return levels
+
+
+def strip_path(path):
+    """Remove the trailing separator of directories (e.g. .zarr)"""
+    return str(path).rstrip('/\\')
+
+
+def read_objects(filename):
+    """Stream a xml object list into numpy arrays.
+
+    The objects are parsed one by one and cleared once read, so the xml tree is
+    never built in memory. The arrays grow by doubling their capacity.
+
+    Returns
+    -------
+    class_labels : numpy.ndarray
+        Class label of each object, of shape (n,).
+    coords : numpy.ndarray
+        x, y, z coordinates of each object, of shape (n, 3).
+    """
+    capacity = 1024
+    class_labels = np.empty(capacity, dtype=np.int64)
+    coords = np.empty((capacity, 3), dtype=np.float64)
+    n = 0
+    for _, element in etree.iterparse(filename, tag='object'):
+        if n == capacity:
+            capacity *= 2
+            class_labels = np.resize(class_labels, capacity)
+            coords = np.resize(coords, (capacity, 3))
+        class_labels[n] = int(element.get('class_label'))
+        coords[n] = (float(element.get('x')), float(element.get('y')), float(element.get('z')))
+        n += 1
+        # free the parsed object and its already parsed siblings
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return class_labels[:n], coords[:n]
+
+
+def read_objects_npz(filename):
+    """Read a binary columnar object list written by write_annotations_npz.
+
+    Returns
+    -------
+    class_labels : numpy.ndarray
+        Class label of each object, of shape (n,).
+    coords : numpy.ndarray
+        x, y, z coordinates of each object, of shape (n, 3).
+    tomo_idx : numpy.ndarray
+        Tomogram index of each object (-1 if unknown), of shape (n,).
+    """
+    with np.load(filename) as objects:
+        return objects['class_label'], objects['coords'], objects['tomo_idx']
+
+
+def is_objects_npz(filename):
+    """Check that a .npz file is an object list and not any other numpy archive"""
+    try:
+        with np.load(filename) as objects:
+            return {'class_label', 'coords', 'tomo_idx'}.issubset(objects.files)
+    except (OSError, ValueError):
+        return False
+
+
+def group_by_class(class_labels, *columns):
+    """Split columns (e.g. coordinates) by class label in a single sort.
+
+    Object lists sorted by class, as written by this plugin, are not reordered,
+    so that the returned groups are views of the columns.
+
+    Returns
+    -------
+    list of tuple
+        (class_label, [column groups]) for each class, sorted by class label.
+    """
+    if np.all(class_labels[:-1] <= class_labels[1:]):
+        sorted_labels = class_labels
+    else:
+        order = np.argsort(class_labels, kind='stable')
+        sorted_labels = class_labels[order]
+        columns = [column[order] for column in columns]
+    unq_label, starts = np.unique(sorted_labels, return_index=True)
+    groups = [np.split(column, starts[1:]) for column in columns]
+    return list(zip(unq_label, zip(*groups)))
+
+
+def is_readable(path):
+    """Check from the path (and the content of .npz archives) if the file can be read"""
+    path = strip_path(path)
+    if path.endswith(tuple(extensions_npz)):
+        return is_objects_npz(path) or is_sparse_labelmap_npz(path)
+    return path.endswith(tuple(extensions))
+
+
 def read_label(filename):
     if filename.endswith(".xml"):
         data = pd.read_xml(filename)
     # else: assuming the data is in ods, xls or xlsx format
     else:
-        data = pd.read_xml(filename)
+        data = pd.read_excel(filename)
     return data
@@ -1,4 +1,4 @@
-from qtpy.QtWidgets import QWidget, QGridLayout, QComboBox, QPushButton, QLabel, QGroupBox, QVBoxLayout, QTextEdit, \
+from qtpy.QtWidgets import QWidget, QGridLayout, QPushButton, QLabel, QGroupBox, QVBoxLayout, QTextEdit, \
     QSpinBox, QCheckBox, QLineEdit, QFileDialog
 from qtpy import QtCore
 import napari
@@ -6,10 +6,17 @@ import napari.layers
 from napari.qt.threading import create_worker
 import numpy as np
 import os
+import shutil
+import tempfile
 from deepfinder.inference import Segment
 from deepfinder.utils import core
 from deepfinder.utils import common as cm
 from deepfinder.utils import smap as sm
+from ._inference import segment_streaming, scoremaps_to_labelmap
+from ._layer_model import LayerComboBox
+from ._multiscale import full_resolution
+from ._sparse import SparseLabelmap
+from ._writer import write_labelmap
 
 
 class SegmentationWidget(QWidget):
@@ -23,13 +30,10 @@ class SegmentationWidget(QWidget):
 
         self.print_signal.connect(self.on_print_signal)
 
-        # Use this event because of bug in viewer.events.layers_change.connect() : it doesn't register name change
-        napari_viewer.layers.events.connect(self._on_layer_change)
-
         self.setLayout(QVBoxLayout())
         # Input group
         self.group_input = QGroupBox('Input')
-        self._input_layer_box = QComboBox()
+        self._input_layer_box = LayerComboBox(napari_viewer, napari.layers.Image)
         self.box_input = QGridLayout()
         # Image layer
         self.box_input.addWidget(QLabel('Image layer:'), 0, 0, QtCore.Qt.AlignTop)
@@ -54,6 +58,10 @@ class SegmentationWidget(QWidget):
         self.patch_size.setSingleStep(4)
         self.box_input.addWidget(QLabel('Patch size:'), 3, 0, QtCore.Qt.AlignTop)
         self.box_input.addWidget(self.patch_size, 3, 1, 1, 2, QtCore.Qt.AlignTop)
+        # Streaming of the scoremaps to disk, so that the memory used does not depend on the tomogram size
+        self.stream_scoremaps = QCheckBox("Stream scoremaps to disk")
+        self.stream_scoremaps.setChecked(True)
+        self.box_input.addWidget(self.stream_scoremaps, 4, 0, 1, 3, QtCore.Qt.AlignTop)
         # Set group
         self.group_input.setLayout(self.box_input)
         self.layout().addWidget(self.group_input)
@@ -80,7 +88,6 @@ class SegmentationWidget(QWidget):
         self.te_terminal_out.setVisible(False)
         self.te_terminal_out.setReadOnly(True)
         self.layout().addWidget(self.te_terminal_out, QtCore.Qt.AlignTop)
-        self._on_layer_change()
 
     def browse_weights(self):
         """Callback called when the browse weights button is clicked"""
@@ -106,20 +113,6 @@ class SegmentationWidget(QWidget):
     def on_print_signal(self, message):  # is called when signal is emmited. Signal passes str 'message' to slot
         self.te_terminal_out.append(message)
 
-    def _on_layer_change(self, event=None):
-        current_text = self._input_layer_box.currentText()
-        self._input_layer_box.clear()
-        is_current_item_still_here = False
-        for layer in self.viewer.layers:
-            if isinstance(layer, napari.layers.image.image.Image):
-                if layer.name == current_text:
-                    is_current_item_still_here = True
-                self._input_layer_box.addItem(layer.name)
-        if is_current_item_still_here:
-            self._input_layer_box.setCurrentText(current_text)
-        else:
-            self._input_layer_box.setCurrentIndex(-1)
-
     def launch_process(self):
         # Get parameters from line edit widgets:
         Ncl = int(self.nb_classes.text())
@@ -127,16 +120,18 @@ class SegmentationWidget(QWidget):
         path_weights = self.weights_path.text()
         path_lmap = self.output_path.text()
 
-        # Load data:
-        current_layer_text = self._input_layer_box.currentText()
-        self.data = self.viewer.layers[current_layer_text].data
+        # Load data (the full resolution of multiscale images):
+        self.data = full_resolution(self._input_layer_box.current_layer().data)
 
         # Initialize segmentation:
         seg = Segment(Ncl=Ncl, path_weights=path_weights, patch_size=psize)
         seg.set_observer(core.observer_gui(self.print_signal))
 
         # Segment data:
-        scoremaps = seg.launch(self.data)
+        if self.stream_scoremaps.isChecked():
+            return self.launch_streaming(seg, path_lmap)
+        # Segment.launch only accepts numpy.ndarray, not its memmap subclass or dask arrays
+        scoremaps = seg.launch(np.asarray(self.data))
 
         seg.display('Saving labelmap ...')
         # Get labelmap from scoremaps and save:
@@ -157,16 +152,37 @@ class SegmentationWidget(QWidget):
         seg.display('Finished !')
         return labelmap_not_converted
 
+    def launch_streaming(self, seg, path_lmap):
+        """Segment the data with scoremaps accumulated in a memory-mapped store, see segment_streaming"""
+        # the store can be as large as the tomogram times the number of classes, keep it next to the labelmap
+        store_dir = tempfile.mkdtemp(prefix='.scoremaps.', dir=os.path.dirname(os.path.abspath(path_lmap)))
+        try:
+            scoremaps = segment_streaming(seg, self.data, store_dir)
+            seg.display('Saving labelmap ...')
+            labelmap_not_converted = scoremaps_to_labelmap(scoremaps, os.path.join(store_dir, 'labelmap.npy'))
+            # the writer inverts the axes from x,y,z to z,y,x, as the transposition of launch_process
+            write_labelmap(path_lmap, labelmap_not_converted, {})
+            if self.bin_label_map.isChecked():
+                s = os.path.splitext(path_lmap)
+                labelmapB = scoremaps_to_labelmap(scoremaps, os.path.join(store_dir, 'labelmap_binned.npy'),
+                                                  binned=True)
+                write_labelmap(s[0] + '_binned' + s[1], labelmapB, {})
+            # compressed before the store is removed
+            labelmap = SparseLabelmap.from_dense(labelmap_not_converted)
+        finally:
+            shutil.rmtree(store_dir, ignore_errors=True)
+        seg.display('Finished !')
+        return labelmap
+
     def add_labels(self, labelmap):
+        # labelmaps are mostly background, keep them compressed in memory
+        if not isinstance(labelmap, SparseLabelmap):
+            labelmap = SparseLabelmap.from_dense(labelmap)
         self.viewer.add_labels(labelmap)
         self._launch_segmentation.setEnabled(True)
 
     def _run(self):
-        # save against edge cases where the name of the layer is modified and the add button is clicked just after
-        old_text = self._input_layer_box.currentText()
-        self._on_layer_change()
-        current_layer_text = self._input_layer_box.currentText()
-        if current_layer_text is not None and current_layer_text != "" and old_text == current_layer_text:
+        if self._input_layer_box.current_layer() is not None:
             self.te_terminal_out.setVisible(True)
             self._launch_segmentation.setEnabled(False)
             worker = create_worker(self.launch_process)
@@ -0,0 +1,56 @@
+import numpy as np
+from scipy.ndimage import uniform_filter
+from ._multiscale import full_resolution
+
+# particles are dark in cryo-electron tomograms, hence the minimum first
+snap_extrema = ['minimum', 'maximum']
+
+
+def snap_to_extremum(data, point, radius: int, extremum: str = 'minimum', filter_size: int = 1):
+    """Position of the intensity extremum of data within radius of point.
+
+    Only a window around point is read from data, so that it stays instant on
+    memory-mapped, dask or multiscale tomograms whatever their size.
+
+    Parameters
+    ----------
+    data : array-like
+        Image layer data, or sequence of levels for multiscale data (the full
+        resolution is used).
+    point : sequence of float
+        Position, in data coordinates.
+    radius : int
+        Radius of the ball searched around point, in voxels.
+    extremum : str
+        'minimum' or 'maximum' (see snap_extrema).
+    filter_size : int
+        Size of a box filter denoising the window before searching the
+        extremum, 1 for none.
+
+    Returns
+    -------
+    numpy.ndarray
+        The position of the extremum, point itself if it is outside data.
+    """
+    data = full_resolution(data)
+    point = np.asarray(point, dtype=np.float64)
+    center = np.rint(point).astype(np.int64)
+    shape = np.array(data.shape)
+    if len(center) != len(shape) or np.any(center < 0) or np.any(center >= shape):
+        return point
+    # the box filter needs a halo around the searched box
+    halo = filter_size // 2
+    low = np.maximum(center - radius - halo, 0)
+    high = np.minimum(center + radius + halo + 1, shape)
+    window = np.asarray(data[tuple(slice(lo, h) for lo, h in zip(low, high))], dtype=np.float32)
+    if filter_size > 1:
+        window = uniform_filter(window, filter_size, mode='reflect')
+    # restrict the search to the ball of the given radius
+    offsets = np.ogrid[tuple(slice(lo - c, h - c) for lo, h, c in zip(low, high, center))]
+    distances = sum(offset ** 2 for offset in offsets)
+    inside = distances <= radius ** 2
+    value = window[inside].min() if extremum == 'minimum' else window[inside].max()
+    # among equal extrema (e.g. in a flat region), the one closest to point
+    candidates = np.where(inside & (window == value), distances, np.inf)
+    index = np.unravel_index(np.argmin(candidates), window.shape)
+    return (low + index).astype(np.float64)
@@ -0,0 +1,247 @@
+import itertools
+import zlib
+import numpy as np
+
+# shape of the blocks of SparseLabelmap, along each axis
+sparse_block_size = 64
+# keys of the .npz archives written by save_sparse_labelmap
+sparse_keys = ('shape', 'block_shape', 'dtype', 'block_index', 'offsets', 'blob')
+
+
+class SparseLabelmap:
+    """Blockwise compressed labelmap.
+
+    The volume is split in blocks: all-zero (background) blocks are not stored
+    and the other ones are kept zlib-compressed. It is an array-like that can be
+    used as data of a napari labels layer: indexing decompresses only the
+    blocks that are touched, and assignments (e.g. painting) recompress them.
+
+    Parameters
+    ----------
+    shape : tuple of int
+    dtype : numpy.dtype
+        Integer dtype of the labels.
+    block_shape : tuple of int, optional
+        Shape of the blocks, sparse_block_size along each axis by default.
+    """
+
+    def __init__(self, shape, dtype=np.int8, block_shape=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        if block_shape is None:
+            block_shape = (sparse_block_size,) * len(self.shape)
+        self.block_shape = tuple(int(n) for n in block_shape)
+        # block index -> compressed block
+        self._blocks = {}
+
+    @classmethod
+    def from_dense(cls, array, block_shape=None):
+        """Compress an array (possibly memory-mapped) block by block"""
+        labelmap = cls(array.shape, array.dtype, block_shape)
+        for block_index in itertools.product(*[range(-(-n // b)) for n, b in
+                                               zip(labelmap.shape, labelmap.block_shape)]):
+            block = np.asarray(array[labelmap._block_slices(block_index)])
+            labelmap._store(block_index, block)
+        return labelmap
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        """Memory used by the compressed blocks"""
+        return sum(len(block) for block in self._blocks.values())
+
+    def copy(self):
+        labelmap = SparseLabelmap(self.shape, self.dtype, self.block_shape)
+        # compressed blocks are immutable bytes, they can be shared
+        labelmap._blocks = dict(self._blocks)
+        return labelmap
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        coords = self._coordinate_arrays(key)
+        if coords is not None:
+            return self._gather(coords)
+        ranges, squeeze = self._ranges(key)
+        result = np.zeros([len(r) for r in ranges], dtype=self.dtype)
+        # only the selected voxels are read, block by block (e.g. for strided keys)
+        for parts in itertools.product(*[self._split_by_block(r, b) for r, b in zip(ranges, self.block_shape)]):
+            block = self._load(tuple(i for i, _, _ in parts))
+            if block is None:
+                continue
+            dst = tuple(positions for _, positions, _ in parts)
+            src = [local for _, _, local in parts]
+            if all(isinstance(local, slice) for local in src):
+                result[dst] = block[tuple(src)]
+            else:
+                src = [np.arange(local.start, local.stop) if isinstance(local, slice) else local for local in src]
+                result[dst] = block[np.ix_(*src)]
+        return result.squeeze(axis=squeeze)
+
+    @staticmethod
+    def _split_by_block(indices, block_size):
+        """Yield (block index, slice of the positions in indices, indices in the block) along an axis.
+
+        The indices are those of a slice, so the positions of a block are
+        contiguous. The indices in the block are a slice when they are too.
+        """
+        blocks = indices // block_size
+        for i in np.unique(blocks):
+            positions = np.flatnonzero(blocks == i)
+            local = indices[positions] - i * block_size
+            if len(local) == 1 or np.all(np.diff(local) == 1):
+                local = slice(int(local[0]), int(local[-1]) + 1)
+            yield int(i), slice(int(positions[0]), int(positions[-1]) + 1), local
+
+    def __setitem__(self, key, value):
+        coords = self._coordinate_arrays(key)
+        if coords is not None:
+            self._scatter(coords, value)
+            return
+        ranges, squeeze = self._ranges(key)
+        if any(len(r) == 0 for r in ranges):
+            return
+        indexed_shape = [len(r) for axis, r in enumerate(ranges) if axis not in squeeze]
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), indexed_shape)
+        # the axes indexed by an integer have a length of 1
+        value = value.reshape([len(r) for r in ranges])
+        low = [int(r.min()) for r in ranges]
+        high = [int(r.max()) + 1 for r in ranges]
+        for block_index in self._blocks_in_box(low, high):
+            block_low = [i * b for i, b in zip(block_index, self.block_shape)]
+            block_shape = self._block_shape(block_index)
+            masks = [(r >= b_lo) & (r < b_lo + n) for r, b_lo, n in zip(ranges, block_low, block_shape)]
+            if not all(mask.any() for mask in masks):
+                continue
+            block = self._load(block_index)
+            if block is None:
+                block = np.zeros(block_shape, dtype=self.dtype)
+            block_coords = [r[mask] - b_lo for r, mask, b_lo in zip(ranges, masks, block_low)]
+            block[np.ix_(*block_coords)] = value[np.ix_(*[np.flatnonzero(mask) for mask in masks])]
+            self._store(block_index, block)
+
+    def _gather(self, coords):
+        values = np.zeros(coords[0].shape, dtype=self.dtype)
+        for block_index, selection in self._group_by_block(coords):
+            block = self._load(block_index)
+            if block is not None:
+                local = tuple(c[selection] - i * b for c, i, b in zip(coords, block_index, self.block_shape))
+                values[selection] = block[local]
+        return values
+
+    def _scatter(self, coords, value):
+        values = np.broadcast_to(np.asarray(value, dtype=self.dtype), coords[0].shape)
+        for block_index, selection in self._group_by_block(coords):
+            block = self._load(block_index)
+            if block is None:
+                block = np.zeros(self._block_shape(block_index), dtype=self.dtype)
+            local = tuple(c[selection] - i * b for c, i, b in zip(coords, block_index, self.block_shape))
+            block[local] = values[selection]
+            self._store(block_index, block)
+
+    def _group_by_block(self, coords):
+        """Yield (block index, boolean selection of the coordinates in this block)"""
+        block_coords = np.stack([c // b for c, b in zip(coords, self.block_shape)], axis=-1)
+        unique_blocks, inverse = np.unique(block_coords.reshape(-1, self.ndim), axis=0, return_inverse=True)
+        inverse = inverse.reshape(coords[0].shape)
+        for i, block_index in enumerate(unique_blocks):
+            yield tuple(int(j) for j in block_index), inverse == i
+
+    def _coordinate_arrays(self, key):
+        """Integer arrays, one per axis (as used by napari to paint), or None for basic indexing"""
+        if not isinstance(key, tuple) or len(key) != self.ndim:
+            return None
+        if not all(isinstance(k, np.ndarray) and k.dtype.kind in 'iu' for k in key):
+            return None
+        coords = np.broadcast_arrays(*key)
+        return [np.where(c < 0, c + n, c) for c, n in zip(coords, self.shape)]
+
+    def _ranges(self, key):
+        """Indices selected along each axis by a basic index, and the axes indexed by an integer"""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        ranges, squeeze = [], []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                ranges.append(np.arange(*k.indices(n)))
+            elif isinstance(k, (int, np.integer)):
+                if not -n <= k < n:
+                    raise IndexError('index %i is out of bounds for axis %i with size %i' % (k, axis, n))
+                ranges.append(np.array([k % n]))
+                squeeze.append(axis)
+            else:
+                raise IndexError('SparseLabelmap only supports integers, slices and coordinate arrays')
+        return ranges, tuple(squeeze)
+
+    def _blocks_in_box(self, low, high):
+        """Indices of the stored or empty blocks overlapping the box [low, high)"""
+        return itertools.product(*[range(lo // b, (h - 1) // b + 1)
+                                   for lo, h, b in zip(low, high, self.block_shape)])
+
+    def _block_slices(self, block_index):
+        return tuple(slice(i * b, (i + 1) * b) for i, b in zip(block_index, self.block_shape))
+
+    def _block_shape(self, block_index):
+        return tuple(min(b, n - i * b) for i, b, n in zip(block_index, self.block_shape, self.shape))
+
+    def _load(self, block_index):
+        compressed = self._blocks.get(block_index)
+        if compressed is None:
+            return None
+        block = np.frombuffer(zlib.decompress(compressed), dtype=self.dtype)
+        return block.reshape(self._block_shape(block_index)).copy()
+
+    def _store(self, block_index, block):
+        if block.any():
+            self._blocks[block_index] = zlib.compress(np.ascontiguousarray(block, dtype=self.dtype).tobytes(), 1)
+        else:
+            self._blocks.pop(block_index, None)
+
+
+def save_sparse_labelmap(labelmap: SparseLabelmap, path: str):
+    """Save the compressed blocks of a SparseLabelmap to a .npz archive"""
+    block_index = sorted(labelmap._blocks)
+    blocks = [labelmap._blocks[i] for i in block_index]
+    np.savez(path,
+             shape=np.array(labelmap.shape),
+             block_shape=np.array(labelmap.block_shape),
+             dtype=np.array(labelmap.dtype.str),
+             block_index=np.array(block_index, dtype=np.int64).reshape(-1, labelmap.ndim),
+             offsets=np.cumsum([0] + [len(block) for block in blocks]),
+             blob=np.frombuffer(b''.join(blocks), dtype=np.uint8))
+
+
+def load_sparse_labelmap(path: str):
+    """Load a SparseLabelmap saved by save_sparse_labelmap, the blocks stay compressed"""
+    with np.load(path) as archive:
+        labelmap = SparseLabelmap(archive['shape'], np.dtype(str(archive['dtype'])), archive['block_shape'])
+        blob = archive['blob'].tobytes()
+        offsets = archive['offsets']
+        for i, block_index in enumerate(archive['block_index']):
+            labelmap._blocks[tuple(int(j) for j in block_index)] = blob[offsets[i]:offsets[i + 1]]
+    return labelmap
+
+
+def is_sparse_labelmap_npz(path: str):
+    """Check that a .npz file is a labelmap saved by save_sparse_labelmap"""
+    try:
+        with np.load(path) as archive:
+            return set(sparse_keys).issubset(archive.files)
+    except (OSError, ValueError):
+        return False
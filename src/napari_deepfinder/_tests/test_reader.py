@@ -1,6 +1,12 @@
 from napari_deepfinder import napari_get_reader
+from napari_deepfinder import _multiscale, _reader
+from napari_deepfinder._cache import LayerDataCache, layer_cache
+from napari_deepfinder._reader import reader_function
+from napari_deepfinder._sparse import SparseLabelmap
+import dask.array as da
 import numpy as np
 import mrcfile
+import os
 
 
 # tmp_path is a pytest fixture
@@ -29,3 +35,170 @@ def test_reader(tmp_path):
 def test_get_reader_pass():
     reader = napari_get_reader("fake.file")
     assert reader is None
+
+
+def test_reader_lazy(tmp_path):
+    my_test_file = str(tmp_path / "tomo.mrc")
+    original_data = np.arange(4 * 5 * 6, dtype=np.float32).reshape((4, 5, 6))
+    with mrcfile.new(my_test_file) as mrc:
+        mrc.set_data(original_data)
+
+    lazy_data = reader_function(my_test_file)[0][0]
+    eager_data = reader_function(my_test_file, lazy=False)[0][0]
+    # the lazy volume is a memory map, reordered to x,y,z without a copy
+    assert isinstance(lazy_data, np.memmap)
+    assert lazy_data.shape == (6, 5, 4)
+    np.testing.assert_array_equal(lazy_data, eager_data)
+
+
+def test_reader_multiscale(tmp_path, monkeypatch):
+    monkeypatch.setattr(_multiscale, 'cache_dir', tmp_path / 'cache')
+    monkeypatch.setattr(_reader, 'min_pyramid_size', 0)
+    my_test_file = str(tmp_path / "tomo.mrc")
+    original_data = np.random.random((16, 16, 16)).astype(np.float32)
+    with mrcfile.new(my_test_file) as mrc:
+        mrc.set_data(original_data)
+
+    data, add_kwargs, layer_type = reader_function(my_test_file)[0]
+    assert add_kwargs['multiscale']
+    assert [level.shape for level in data] == [(16, 16, 16), (8, 8, 8), (4, 4, 4), (2, 2, 2)]
+    # the downsampled levels are lazy until they are cached in the background
+    assert isinstance(data[1], da.Array)
+    np.testing.assert_allclose(data[1][0, 0, 0].compute(), original_data[:2, :2, :2].mean(), rtol=1e-6)
+    for thread in list(_multiscale._cache_threads.values()):
+        thread.join()
+    # the second opening reuses the cached levels
+    assert len(list((tmp_path / 'cache').glob('*/image_*.npy'))) == 3
+    cached = reader_function(my_test_file)[0][0]
+    assert isinstance(cached[3], np.memmap)
+    np.testing.assert_allclose(cached[3], data[3].compute(), rtol=1e-6)
+
+
+def test_pyramid_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(_multiscale, 'cache_dir', tmp_path / 'cache')
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / ('tomo%i.mrc' % i)))
+        with mrcfile.new(paths[-1]) as mrc:
+            mrc.set_data(np.zeros((16, 16, 16), dtype=np.float32))
+    # one pyramid is 8 ** 3 + 4 ** 3 + 2 ** 3 float32 values, plus the .npy headers
+    monkeypatch.setattr(_multiscale, 'max_cache_bytes', 2 * 4 * (8 ** 3 + 4 ** 3 + 2 ** 3) + 1000)
+    for i, path in enumerate(paths):
+        data = reader_function(path, lazy=True)[0][0]
+        _multiscale.get_pyramid(data, path)
+        for thread in list(_multiscale._cache_threads.values()):
+            thread.join()
+        folder = tmp_path / 'cache' / _multiscale.cache_key(path)
+        os.utime(folder, (i, i))
+    # the least recently used pyramid was deleted
+    assert not (tmp_path / 'cache' / _multiscale.cache_key(paths[0])).exists()
+    assert (tmp_path / 'cache' / _multiscale.cache_key(paths[2])).exists()
+
+
+def test_pyramid_cache_eviction_race(tmp_path, monkeypatch):
+    monkeypatch.setattr(_multiscale, 'cache_dir', tmp_path / 'cache')
+    monkeypatch.setattr(_multiscale, 'max_cache_bytes', 0)
+    # a level renamed or deleted by another thread while the cache is scanned
+    (tmp_path / 'cache' / 'other').mkdir(parents=True)
+    os.symlink(tmp_path / 'missing.npy', tmp_path / 'cache' / 'other' / 'image_2.npy')
+    data = np.random.random((8, 8, 8)).astype(np.float32)
+    folder = tmp_path / 'cache' / 'tomo'
+    level_paths = [folder / ('image_%i.npy' % factor) for factor in (2, 4)]
+    _multiscale.write_pyramid(data, folder, level_paths)
+    # the pyramid that was just written is kept
+    assert all(level_path.exists() for level_path in level_paths)
+
+
+def test_reader_multiscale_labels(tmp_path, monkeypatch):
+    monkeypatch.setattr(_multiscale, 'cache_dir', tmp_path / 'cache')
+    monkeypatch.setattr(_reader, 'min_pyramid_size', 0)
+    my_test_file = str(tmp_path / "labelmap.mrc")
+    with mrcfile.new(my_test_file) as mrc:
+        mrc.set_data(np.random.randint(0, 3, (16, 16, 16)).astype(np.int8))
+
+    # labelmaps stay single-scale, as napari does not allow painting multiscale labels
+    data, add_kwargs, layer_type = reader_function(my_test_file)[0]
+    assert layer_type == "labels"
+    assert not add_kwargs.get('multiscale')
+    assert isinstance(data, np.memmap)
+    assert not (tmp_path / 'cache').exists()
+    assert _multiscale.full_resolution(data) is data
+    assert _multiscale.full_resolution([data, data[::2, ::2, ::2]]) is data
+
+
+def test_reader_objects(tmp_path):
+    my_test_file = str(tmp_path / "objl.xml")
+    with open(my_test_file, 'w') as f:
+        f.write('<objlist>\n'
+                '  <object tomo_idx="0" class_label="2" x="1" y="2" z="3"/>\n'
+                '  <object tomo_idx="0" class_label="1" x="4" y="5" z="6"/>\n'
+                '  <object tomo_idx="0" class_label="2" x="7" y="8" z="9"/>\n'
+                '</objlist>\n')
+
+    layer_data_list = reader_function(my_test_file)
+    assert [layer[1]['name'] for layer in layer_data_list] == ['objl_1', 'objl_2']
+    np.testing.assert_array_equal(layer_data_list[0][0], [[4, 5, 6]])
+    np.testing.assert_array_equal(layer_data_list[1][0], [[1, 2, 3], [7, 8, 9]])
+
+
+def test_reader_multiple_files(tmp_path):
+    paths = []
+    for i in range(4):
+        paths.append(str(tmp_path / ("tomo%i.mrc" % i)))
+        with mrcfile.new(paths[-1]) as mrc:
+            mrc.set_data(np.full((2, 3, 4), i, dtype=np.float32))
+
+    layer_data_list = napari_get_reader(paths)(paths)
+    # layers are returned in the order of the paths
+    assert [layer[0][0, 0, 0] for layer in layer_data_list] == [0, 1, 2, 3]
+
+
+def test_probe_tomogram(tmp_path):
+    my_test_file = str(tmp_path / "tomo.mrc")
+    original_data = np.arange(4 * 5 * 6, dtype=np.float32).reshape((4, 5, 6))
+    with mrcfile.new(my_test_file) as mrc:
+        mrc.set_data(original_data)
+        mrc.voxel_size = (1.5, 2.5, 3.5)
+
+    header = _reader.probe_tomogram(my_test_file)
+    assert header == {'dtype': np.dtype(np.float32), 'shape': (6, 5, 4), 'voxel_size': (1.5, 2.5, 3.5)}
+    data, add_kwargs, layer_type = reader_function(my_test_file)[0]
+    assert layer_type == "image"
+    assert add_kwargs['contrast_limits'] == [0, 4 * 5 * 6 - 1]
+    assert add_kwargs['metadata']['voxel_size'] == (1.5, 2.5, 3.5)
+
+
+def test_reader_cache(tmp_path):
+    my_test_file = str(tmp_path / "objl.xml")
+    with open(my_test_file, 'w') as f:
+        f.write('<objlist>\n  <object class_label="1" x="1" y="2" z="3"/>\n</objlist>\n')
+
+    first = reader_function(my_test_file)[0][0]
+    first[0, 0] = 100  # layers edit their data in place
+    assert layer_cache.get(my_test_file, lazy=True, multiscale=True) is not None
+    np.testing.assert_array_equal(reader_function(my_test_file)[0][0], [[1, 2, 3]])
+    # a modified file is decoded again
+    with open(my_test_file, 'w') as f:
+        f.write('<objlist>\n  <object class_label="1" x="4" y="5" z="6"/>\n</objlist>\n')
+    os.utime(my_test_file, ns=(0, 0))
+    np.testing.assert_array_equal(reader_function(my_test_file)[0][0], [[4, 5, 6]])
+
+
+def test_layer_cache_labels(tmp_path):
+    cache = LayerDataCache()
+    my_test_file = str(tmp_path / "labelmap.npz")
+    open(my_test_file, 'w').close()
+    dense = np.zeros((128, 64, 64), dtype=np.int8)
+    dense[70:80, 10:20, 10:20] = 2
+    labelmap = SparseLabelmap.from_dense(dense)
+    cache.put(my_test_file, [(labelmap, {}, "labels")])
+    first = cache.get(my_test_file)[0][0]
+    # copies share the compressed blocks, painting replaces the blocks of the copy only
+    assert first._blocks[(1, 0, 0)] is labelmap._blocks[(1, 0, 0)]
+    first[75, 15, 15] = 1
+    assert first._blocks[(1, 0, 0)] is not labelmap._blocks[(1, 0, 0)]
+    np.testing.assert_array_equal(cache.get(my_test_file)[0][0], dense)
+    # dense labels are not cached, since they would be copied in full
+    cache.clear()
+    cache.put(my_test_file, [(dense, {}, "labels")])
+    assert cache.get(my_test_file) is None
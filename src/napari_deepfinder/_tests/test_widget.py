@@ -1,13 +1,26 @@
 import numpy as np
 import pytest
+import warnings
 import collections
-from scipy.ndimage import uniform_filter
+import dask.array as da
+import napari
+import napari.layers
+from scipy.ndimage import uniform_filter, gaussian_filter
 from qtpy import QtCore
+from napari_deepfinder import _denoise, _inference, _peaks
+from napari_deepfinder._denoise import uniform_filter_parallel, SummedVolumeTable, Spectrum, denoise, denoise_preview, \
+    iter_lowpass_chunked, run_steps, _summed_volume_tables, _spectra
+from napari_deepfinder._layer_model import LayerComboBox
+from napari_deepfinder._points_index import points_index
+from napari_deepfinder._snap import snap_to_extremum
+from napari_deepfinder._peaks import find_peaks
+from napari_deepfinder._inference import segment_streaming, scoremaps_to_labelmap
 
 from napari_deepfinder import (
     AddPointsWidget,
     ClusterWidget,
     Orthoslice,
+    PickingWidget,
     SegmentationWidget,
     reorder_widget,
     denoise_widget
@@ -62,12 +75,235 @@ def test_add_points(make_napari_viewer, qtbot):
     viewer.add_points(data=None, ndim=3, name="test_layer")
     my_widget._input_layer_box.setCurrentText("test_layer")
     assert np.array_equal(viewer.layers["test_layer"].data, np.empty([0, 3]))
+    position = viewer.dims.point
     qtbot.mouseClick(my_widget._add_point, QtCore.Qt.LeftButton)
-    assert np.array_equal(viewer.layers["test_layer"].data, np.array([[256., 256., 256.]]))
+    # the point is added at the world position of the viewer
+    assert np.array_equal(viewer.layers["test_layer"].data, np.array([position]))
+    # adding a point at the same place again warns
+    with pytest.warns(UserWarning, match="already at a distance of 0.0"):
+        qtbot.mouseClick(my_widget._add_point, QtCore.Qt.LeftButton)
+    assert np.array_equal(viewer.layers["test_layer"].data, np.array([position, position]))
+    # only the points of the target layer are checked
+    viewer.add_points(data=None, ndim=3, name="other_layer")
+    my_widget._input_layer_box.setCurrentText("other_layer")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        qtbot.mouseClick(my_widget._add_point, QtCore.Qt.LeftButton)
+    assert np.array_equal(viewer.layers["other_layer"].data, np.array([position]))
     my_widget.deleteLater()
     qtbot.wait(10)
 
 
+def test_layer_combo_box(qtbot):
+    from napari.components import ViewerModel
+    viewer = ViewerModel()
+    viewer.add_points(data=None, ndim=3, name="points")
+    box = LayerComboBox(viewer, napari.layers.Points)
+    other_box = LayerComboBox(viewer, napari.layers.Points)
+    # the model is shared by the widgets, and no layer is selected at first
+    assert box.model() is other_box.model()
+    assert box.currentIndex() == -1
+    viewer.add_image(data=np.zeros((16, 16)), name="image")
+    viewer.add_points(data=None, ndim=3, name="points2")
+    box.setCurrentText("points2")
+    resets = []
+    box.model().modelReset.connect(lambda: resets.append(True))
+    viewer.layers["points"].name = "renamed"
+    viewer.layers.move(2, 0)
+    assert [box.itemText(i) for i in range(box.count())] == ["points2", "renamed"]
+    assert box.current_layer() is viewer.layers["points2"]
+    assert other_box.currentIndex() == -1
+    viewer.layers.remove("points2")
+    assert box.currentIndex() == -1
+    assert [box.itemText(i) for i in range(box.count())] == ["renamed"]
+    assert not resets
+
+
+def test_points_index():
+    rng = np.random.default_rng(0)
+    layer = napari.layers.Points(rng.uniform(0, 50, (100, 3)))
+    index = points_index(layer)
+    layer.add(rng.uniform(0, 50, (5, 3)))
+    layer.remove([0, 10, 102])
+    layer.data[[3, 50]] += 1
+    layer.events.data(value=layer.data, action='changed', data_indices=(3, 50), vertex_indices=((),))
+    for point in rng.uniform(0, 50, (20, 3)):
+        distances = np.linalg.norm(layer.data - point, axis=1)
+        assert index.nearest(point) == (np.argmin(distances), pytest.approx(distances.min()))
+        assert np.array_equal(index.query_radius(point, 10), np.flatnonzero(distances <= 10))
+    layer.data = np.zeros((0, 3))
+    assert index.nearest([0, 0, 0]) == (None, np.inf)
+
+
+def test_snap_to_extremum(tmp_path):
+    image = np.lib.format.open_memmap(tmp_path / "image.npy", mode="w+", dtype=np.float32, shape=(64, 64, 64))
+    image[:] = 1
+    image[12, 11, 9] = -5
+    image[5, 5, 5] = -10
+    assert np.array_equal(snap_to_extremum(image, (10, 10, 10), 3), [12, 11, 9])
+    # the point stays in place in a flat neighbourhood
+    assert np.array_equal(snap_to_extremum(image, (10, 10, 10), 2), [10, 10, 10])
+    assert np.array_equal(snap_to_extremum(image, (10, 10, 10), 3, 'maximum'), [10, 10, 10])
+    # a dark particle next to a darker noisy voxel, that the box filter smooths out
+    image[4:7, 4:7, 4:7] = -5
+    image[8, 8, 8] = -20
+    assert np.array_equal(snap_to_extremum(image, (6, 6, 7), 3), [8, 8, 8])
+    assert np.array_equal(snap_to_extremum([image], (6, 6, 7), 3, 'minimum', 3), [5, 5, 5])
+    # napari wraps multiscale data in a MultiScaleData, which is neither a list nor a tuple
+    layer = napari.layers.Image([image, image[::2, ::2, ::2]], multiscale=True)
+    assert np.array_equal(snap_to_extremum(layer.data, (6, 6, 7), 3), [8, 8, 8])
+
+
+def test_find_peaks(monkeypatch):
+    rng = np.random.default_rng(0)
+    image = rng.normal(size=(60, 50, 40)).astype(np.float32)
+    coords, values = find_peaks(image, 3, n_threads=1)
+    # the peaks do not depend on the slabs
+    monkeypatch.setattr(_peaks, 'peak_slab_size', 50 * 40 * 5)
+    assert np.array_equal(find_peaks(image, 3, n_threads=4)[0], coords)
+    assert np.array_equal(values, image[tuple(coords.astype(int).T)])
+    assert np.all(np.diff(values) <= 0)
+    distances = np.linalg.norm(coords[:, None] - coords[None], axis=-1)
+    assert np.all(distances[np.triu_indices(len(coords), 1)] >= 3)
+    coords, values = find_peaks(image, 3, threshold=-3, extremum='minimum')
+    assert np.all(values <= -3) and values[0] == image.min()
+    # napari wraps multiscale data in a MultiScaleData, which is neither a list nor a tuple
+    layer = napari.layers.Image([image, image[::2, ::2, ::2]], multiscale=True)
+    assert np.array_equal(find_peaks(layer.data, 3, threshold=-3, extremum='minimum')[0], coords)
+    # the flat background of a scoremap is not a peak
+    scoremap = np.zeros((30, 30, 30), dtype=np.float32)
+    assert len(find_peaks(scoremap, 3)[0]) == 0
+    scoremap[10, 12, 14] = 1
+    assert np.array_equal(find_peaks(scoremap, 3)[0], [[10, 12, 14]])
+    labelmap = np.zeros((40, 40, 40), dtype=np.int8)
+    labelmap[5:12, 5:12, 5:12] = 2
+    labelmap[30:36, 5:10, 5:10] = 1
+    assert np.array_equal(find_peaks(labelmap, 3, label=2)[0], [[8, 8, 8]])
+
+
+def test_picking(make_napari_viewer, qtbot):
+    viewer = make_napari_viewer()
+    image = np.zeros((32, 32, 32), dtype=np.float32)
+    image[10, 12, 14] = 1
+    viewer.add_image(image, name="scoremap")
+    my_widget = PickingWidget(viewer)
+    my_widget._input_layer_box.setCurrentText("scoremap")
+    my_widget.class_label.setValue(3)
+    # the threshold must be a number
+    my_widget.threshold.setText("-")
+    with pytest.warns(UserWarning, match="not a number"):
+        qtbot.mouseClick(my_widget._launch_picking, QtCore.Qt.LeftButton)
+    my_widget.threshold.setText("0.5")
+    qtbot.mouseClick(my_widget._launch_picking, QtCore.Qt.LeftButton)
+    qtbot.waitUntil(lambda: "scoremap_candidates_3" in viewer.layers, timeout=10000)
+    candidates = viewer.layers["scoremap_candidates_3"]
+    assert np.array_equal(candidates.data, [[10, 12, 14]])
+    # displayed as the annotations opened by the reader
+    assert candidates.out_of_slice_display and np.all(candidates.size == 10)
+    my_widget.deleteLater()
+    qtbot.wait(10)
+
+
+class PixelNet:
+    """Stand-in for the network of Segment, predicting 3 scores per voxel from its value"""
+    def predict(self, patch, batch_size=1):
+        values = patch[..., :1]
+        return np.concatenate([np.abs(values), 1 / (1 + np.exp(values)), 1 / (1 + np.exp(-values))], axis=-1)
+
+
+def test_segment_streaming(tmp_path, monkeypatch):
+    from deepfinder.inference import Segment
+    from deepfinder.utils import core
+    from deepfinder.utils import smap as sm
+    segment = Segment.__new__(Segment)
+    core.DeepFinder.__init__(segment)
+    segment.Ncl, segment.P, segment.pcrop, segment.poverlap = 3, 16, 4, 13
+    segment.path_weights = str(tmp_path / "weights.h5")
+    segment.net = PixelNet()
+    data = np.random.default_rng(0).normal(2, 3, (37, 30, 25)).astype(np.float32)
+    expected = segment.launch(data.copy())
+    monkeypatch.setattr(_inference, 'scoremap_slab_size', 300)
+    scoremaps = segment_streaming(segment, data, str(tmp_path))
+    # up to the rounding of the normalization statistics
+    assert np.allclose(scoremaps, expected, atol=2e-3)
+    labelmap = scoremaps_to_labelmap(scoremaps, str(tmp_path / "labelmap.npy"))
+    assert np.array_equal(labelmap, sm.to_labelmap(expected))
+    binned = scoremaps_to_labelmap(scoremaps, str(tmp_path / "binned.npy"), binned=True)
+    # averages of 2x2x2 tiles of the float16 scoremaps, as smap.bin
+    padded = np.pad(expected, [(0, 1), (0, 0), (0, 1), (0, 0)])
+    expected_binned = padded.reshape(19, 2, 15, 2, 13, 2, 3).mean(axis=(1, 3, 5))
+    assert np.array_equal(binned, np.argmax(expected_binned, axis=3))
+    # napari wraps multiscale data in a MultiScaleData, which is neither a list nor a tuple
+    layer = napari.layers.Image([data, data[::2, ::2, ::2]], multiscale=True)
+    (tmp_path / "multiscale").mkdir()
+    assert np.array_equal(segment_streaming(segment, layer.data, str(tmp_path / "multiscale")), scoremaps)
+
+
+def test_multiscale_layer(tmp_path, monkeypatch, qtbot):
+    import mrcfile
+    from deepfinder.inference import Segment
+    from deepfinder.utils import core
+    from napari.components import ViewerModel
+    from napari_deepfinder import _multiscale, _reader
+    from napari_deepfinder._background import save_tomogram
+    monkeypatch.setattr(_multiscale, 'cache_dir', tmp_path / 'cache')
+    monkeypatch.setattr(_reader, 'min_pyramid_size', 0)
+    monkeypatch.setattr(napari, 'current_viewer', lambda: None)
+    path = str(tmp_path / "tomo.mrc")
+    image = np.random.default_rng(0).normal(size=(32, 32, 32)).astype(np.float32)
+    image[20, 11, 7] = 10
+    with mrcfile.new(path) as mrc:
+        mrc.set_data(image.transpose((2, 1, 0)))
+    # a tomogram opened as a multiscale layer, as napari does with the reader output
+    viewer = ViewerModel()
+    data, add_kwargs, layer_type = _reader.reader_function(path)[0]
+    layer = viewer.add_layer(napari.layers.Layer.create(data, dict(add_kwargs, name="tomo"), layer_type))
+    assert layer.multiscale and not isinstance(layer.data, (list, tuple))
+    # writers
+    saved = save_tomogram(str(tmp_path / "saved.mrc"), layer.data, {'name': 'tomo'})
+    np.testing.assert_array_equal(_reader.reader_function(saved)[0][0][0], image)
+    # denoising
+    np.testing.assert_allclose(denoise(layer, 3), uniform_filter(image, size=3), atol=1e-5)
+    np.testing.assert_allclose(denoise_preview(layer.data, 3)[0][5], uniform_filter(image, size=3)[5], atol=1e-5)
+    # snapping of added points
+    add_widget = AddPointsWidget(viewer)
+    viewer.add_points(data=None, ndim=3, name="particle_1")
+    add_widget._input_layer_box.setCurrentText("particle_1")
+    add_widget._snap_layer_box.setCurrentText("tomo")
+    add_widget.snap_extremum.setCurrentText("maximum")
+    add_widget.group_snap.setChecked(True)
+    viewer.dims.point = (19, 12, 8)
+    add_widget._run()
+    np.testing.assert_array_equal(viewer.layers["particle_1"].data, [[20, 11, 7]])
+    # picking
+    picking_widget = PickingWidget(viewer)
+    name, coords = picking_widget.launch_process(layer, 3, 5, 'maximum', 2)
+    assert name == "tomo_candidates_2"
+    np.testing.assert_array_equal(coords, [[20, 11, 7]])
+    # segmentation
+    segment = Segment.__new__(Segment)
+    core.DeepFinder.__init__(segment)
+    segment.Ncl, segment.P, segment.pcrop, segment.poverlap = 3, 16, 4, 13
+    segment.path_weights = str(tmp_path / "weights.h5")
+    segment.net = PixelNet()
+    assert segment_streaming(segment, layer.data, str(tmp_path)).shape == image.shape + (3,)
+    # clustering of multiscale labels (e.g. a pyramidal OME-Zarr labelmap)
+    labelmap = np.zeros((32, 32, 32), dtype=np.int8)
+    labelmap[18:23, 9:14, 5:10] = 1
+    viewer.add_labels([labelmap, labelmap[::2, ::2, ::2]], name="labelmap")
+    cluster_widget = ClusterWidget(viewer)
+    cluster_widget._input_layer_box.setCurrentText("labelmap")
+    cluster_widget.cluster_radius.setValue(5)
+    cluster_widget.size_threshold.setValue(1)
+    cluster_widget.output_path.setText(str(tmp_path / "objl.xml"))
+    cluster_widget.launch_process()
+    # the objects are in full resolution coordinates
+    assert len(cluster_widget.objlist) == 1
+    assert [cluster_widget.objlist[0][axis] for axis in 'xyz'] == [20, 11, 7]
+    for thread in list(_multiscale._cache_threads.values()):
+        thread.join()
+
+
 def test_reorder_layers(make_napari_viewer, qtbot):
     viewer = make_napari_viewer()
     my_widget = reorder_widget()
@@ -76,8 +312,14 @@ def test_reorder_layers(make_napari_viewer, qtbot):
     viewer.add_points(data=None, ndim=3, name="points2")
     viewer.add_image(data=np.zeros((512, 512, 200)), name="image")
     assert [layer.name for layer in viewer.layers] == ["points", "labels", "points2", "image"]
+    reordered = []
+    viewer.layers.events.reordered.connect(reordered.append)
     my_widget(viewer)
     assert [layer.name for layer in viewer.layers] == ["image", "points", "points2", "labels"]
+    # a single batched reordering
+    assert len(reordered) == 1
+    my_widget(viewer)
+    assert len(reordered) == 1
     qtbot.wait(10)
 
 
@@ -90,7 +332,126 @@ def test_denoise_widget(make_napari_viewer, qtbot):
     filter_size = 2
     filtered_image = uniform_filter(checkerboard, size=filter_size)
     my_widget(viewer, viewer.layers['image'], 2, True)
+    # denoising runs in a background worker
+    qtbot.waitUntil(lambda: "image_denoised" in viewer.layers, timeout=5000)
     assert np.array_equal(viewer.layers["image_denoised"].data, filtered_image)
+    # changing the filter size cancels the running job, only the newest result is displayed
+    my_widget(viewer, viewer.layers['image'], 3, True)
+    my_widget(viewer, viewer.layers['image'], 4, True)
+    qtbot.waitUntil(lambda: my_widget.worker is None, timeout=5000)
+    assert np.array_equal(viewer.layers["image_denoised"].data, uniform_filter(checkerboard, size=4))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.uint8, np.int16])
+def test_uniform_filter_parallel(dtype):
+    image = (np.random.random((37, 20, 9)) * 100).astype(dtype)
+    for filter_size in [1, 2, 3, 8]:
+        for n_threads in [1, 4]:
+            filtered = uniform_filter_parallel(image, filter_size, n_threads)
+            assert filtered.dtype == image.dtype
+            # bit-identical
+            assert np.array_equal(filtered, uniform_filter(image, size=filter_size))
+    transposed = np.transpose(image, (2, 1, 0))
+    assert np.array_equal(uniform_filter_parallel(transposed, 5, 3), uniform_filter(transposed, size=5))
+
+
+def test_summed_volume_table():
+    image = np.random.random((37, 20, 9)).astype(np.float32)
+    table = SummedVolumeTable(image, 8)
+    for filter_size in [1, 2, 3, 8, 17]:
+        filtered = table.uniform_filter(filter_size)
+        assert filtered.dtype == image.dtype
+        np.testing.assert_allclose(filtered, uniform_filter(image, size=filter_size), atol=1e-5)
+    with pytest.raises(ValueError):
+        table.uniform_filter(18)
+    # the table is cached per layer, and dropped when the layer data changes
+    layer = napari.layers.Image(image)
+    denoise(layer, 3, 'summed volume table')
+    table = _summed_volume_tables[layer]
+    denoise(layer, 5, 'summed volume table')
+    assert _summed_volume_tables[layer] is table
+    layer.data = image * 2
+    assert layer not in _summed_volume_tables
+    np.testing.assert_allclose(denoise(layer, 5, 'summed volume table'), uniform_filter(image * 2, size=5), atol=1e-5)
+
+
+def test_denoise_preview():
+    image = np.random.random((30, 20, 10)).astype(np.float32)
+    for filter_size in [2, 5, 12]:
+        preview = denoise_preview(image, filter_size)
+        np.testing.assert_allclose(preview[7], uniform_filter(image, size=filter_size)[7], atol=1e-6)
+        np.testing.assert_allclose(preview[:, 3], uniform_filter(image, size=filter_size)[:, 3], atol=1e-6)
+    preview = denoise_preview(image, 3, dtype=np.float16)
+    for key in [(slice(2, 25, 4), -1), (Ellipsis, slice(None, None, -3)), (slice(5, 5),), (slice(20, 3, -2), 4, 1)]:
+        np.testing.assert_allclose(preview[key], uniform_filter(image, size=3)[key].astype(np.float16), atol=1e-3)
+    np.testing.assert_allclose(np.asarray(preview), uniform_filter(image, size=3), atol=1e-3)
+
+
+def test_denoise_preview_reads():
+    image = np.random.random((32, 32, 32)).astype(np.float32)
+    read_chunks = []
+
+    def read_chunk(block_info=None):
+        location = block_info[None]['array-location']
+        read_chunks.append(location)
+        return image[tuple(slice(start, stop) for start, stop in location)]
+
+    data = da.map_blocks(read_chunk, chunks=((8,) * 4,) * 3, dtype=image.dtype, meta=np.empty((0,) * 3, image.dtype))
+    preview = denoise_preview(data, 3)
+    # a slice only reads the source chunks within the filter halo, along any axis
+    np.testing.assert_allclose(preview[3], uniform_filter(image, size=3)[3], atol=1e-6)
+    assert len(read_chunks) == 4 * 4
+    read_chunks.clear()
+    np.testing.assert_allclose(preview[:, :, 12], uniform_filter(image, size=3)[:, :, 12], atol=1e-6)
+    assert len(read_chunks) == 4 * 4
+    # multiscale data gives a multiscale preview, filtered according to the downsampling of each level
+    layer = napari.layers.Image([image, image[::2, ::2, ::2]], multiscale=True)
+    previews = denoise_preview(layer.data, 4)
+    assert [preview.filter_size for preview in previews] == [4, 2]
+    np.testing.assert_allclose(previews[1][5], uniform_filter(image[::2, ::2, ::2], size=2)[5], atol=1e-6)
+    assert napari.layers.Image(previews, multiscale=True).data.shape == image.shape
+    # and the whole volume is denoised at full resolution
+    np.testing.assert_allclose(denoise(layer, 3), uniform_filter(image, size=3), atol=1e-6)
+
+
+def test_lowpass_denoising(monkeypatch):
+    image = np.random.random((40, 36, 30)).astype(np.float32)
+    layer = napari.layers.Image(image)
+    # the gaussian low-pass filter of cutoff 1 / filter_size is a periodic gaussian filter of sigma filter_size / 2pi
+    filtered = denoise(layer, 10, 'gaussian low-pass (fft)')
+    assert filtered.dtype == image.dtype
+    np.testing.assert_allclose(filtered, gaussian_filter(image, 10 / (2 * np.pi), mode='wrap', truncate=6), atol=1e-5)
+    # the spectrum is cached per layer, and dropped when the layer data changes
+    spectrum = _spectra[layer]
+    butterworth = denoise(layer, 8, 'butterworth low-pass (fft)')
+    assert _spectra[layer] is spectrum
+    assert abs(butterworth.mean() - image.mean()) < 1e-5
+    layer.data = image * 2
+    assert layer not in _spectra
+    # blocks with a halo match the whole volume away from its borders
+    monkeypatch.setattr(_denoise, 'lowpass_block_size', 16)
+    chunked = run_steps(iter_lowpass_chunked(image, 8, 'butterworth'))
+    whole = run_steps(Spectrum(image).iter_lowpass(8, 'butterworth'))
+    np.testing.assert_allclose(chunked[10:-10, 10:-10, 10:-10], whole[10:-10, 10:-10, 10:-10], atol=1e-3)
+
+
+@pytest.mark.parametrize("engine", ['exact', 'summed volume table', 'gaussian low-pass (fft)'])
+def test_denoise_dtype_and_memory_budget(engine, monkeypatch):
+    image = (np.random.random((30, 20, 10)) * 200).astype(np.uint8)
+    layer = napari.layers.Image(image)
+    in_memory = denoise(layer, 3, engine, np.float16)
+    assert in_memory.dtype == np.float16 and not isinstance(in_memory, np.memmap)
+    # the result is written into the given buffer
+    output = np.empty(image.shape, dtype=np.float32)
+    assert denoise(layer, 3, engine, np.float32, output) is output
+    if engine == 'exact':
+        assert np.array_equal(output, uniform_filter(image, size=3, output=np.float32))
+    # over the memory budget, the result is computed by chunks into a temporary file
+    monkeypatch.setattr(_denoise, 'denoise_memory_budget', image.size)
+    chunked = denoise(layer, 3, engine, np.float32)
+    assert isinstance(chunked, np.memmap)
+    np.testing.assert_allclose(chunked[5:-5, 5:-5, 5:-5], output[5:-5, 5:-5, 5:-5], atol=0.1)
+
 
 
 def test_orthoslice_add_layer(make_napari_viewer, qtbot):
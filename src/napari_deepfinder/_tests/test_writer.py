@@ -1,6 +1,13 @@
-from napari_deepfinder import write_annotations_xml, write_labelmap, write_tomogram
+from napari_deepfinder import write_annotations_xml, write_annotations_npz, write_labelmap, write_tomogram
+from napari_deepfinder._reader import reader_function
 import numpy as np
+import pytest
 import os
+import mrcfile
+import napari
+import zarr
+from napari_deepfinder import _writer
+from napari_deepfinder._sparse import SparseLabelmap
 
 
 def test_writing_one_layer(tmp_path):
@@ -34,3 +41,248 @@ def test_writing_tomogram(tmp_path):
     write_tomogram(path, data, {'name': 'test'})
     write_tomogram(path_with_extension, data, {'name': 'test'})
 
+
+
+def test_writing_zarr(tmp_path):
+    tomo = np.random.random((70, 10, 3)).astype(np.float32)
+    labelmap = np.zeros((70, 10, 3), dtype=np.int8)
+    labelmap[60:, 2:5, 1] = 3
+    tomo_path = write_tomogram(os.path.join(str(tmp_path), "test_tomo.zarr"), tomo, {'name': 'test'})
+    labelmap_path = write_labelmap(os.path.join(str(tmp_path), "test_labelmap.zarr"), labelmap, {'name': 'test'})
+    tomo_read, _, tomo_type = reader_function(tomo_path)[0]
+    labelmap_read, _, labelmap_type = reader_function(labelmap_path + '/')[0]
+    assert (tomo_type, labelmap_type) == ("image", "labels")
+    np.testing.assert_array_equal(np.asarray(tomo_read), tomo)
+    np.testing.assert_array_equal(np.asarray(labelmap_read), labelmap)
+    # the store format matches the OME-Zarr version of the metadata
+    root = zarr.open_group(tomo_path, mode='r')
+    assert root.attrs['multiscales'][0]['version'] == '0.4'
+    assert os.path.exists(os.path.join(tomo_path, '.zgroup'))
+    assert os.path.exists(os.path.join(tomo_path, '0', '.zarray'))
+    assert not os.path.exists(os.path.join(tomo_path, 'zarr.json'))
+
+
+def test_writing_annotations_round_trip(tmp_path):
+    data = np.array([[1.7, 2, 3], [4, 5, 6]])
+    data_2 = np.array([[7, 8, 9]])
+    path = write_annotations_xml(os.path.join(str(tmp_path), "objl"),
+                                 [(data, {'name': 'test_2'}, 'points'),
+                                  (data_2, {'name': 'other_1'}, 'points')])
+    with open(path) as f:
+        assert f.read() == ('<objlist>\n'
+                            '  <object tomo_idx="" class_label="1" x="7" y="8" z="9"/>\n'
+                            '  <object tomo_idx="" class_label="2" x="1" y="2" z="3"/>\n'
+                            '  <object tomo_idx="" class_label="2" x="4" y="5" z="6"/>\n'
+                            '</objlist>\n')
+    layer_data_list = reader_function(path)
+    np.testing.assert_array_equal(layer_data_list[1][0], [[1, 2, 3], [4, 5, 6]])
+
+
+def test_writing_annotations_npz(tmp_path):
+    data = np.array([[1.5, 2, 3], [4, 5, 6]])
+    data_2 = np.array([[7, 8, 9]])
+    path = write_annotations_npz(os.path.join(str(tmp_path), "objl"),
+                                 [(data, {'name': 'test_2', 'features': {'tomo_idx': [3, 4]}}, 'points'),
+                                  (data_2, {'name': 'other_1'}, 'points')])
+    assert path.endswith('.npz')
+    layer_data_list = reader_function(path)
+    assert [layer[1]['name'] for layer in layer_data_list] == ['objl_1', 'objl_2']
+    np.testing.assert_array_equal(layer_data_list[0][0], data_2)
+    np.testing.assert_array_equal(layer_data_list[1][0], data)
+    np.testing.assert_array_equal(layer_data_list[0][1]['features']['tomo_idx'], [-1])
+    np.testing.assert_array_equal(layer_data_list[1][1]['features']['tomo_idx'], [3, 4])
+
+
+def test_writing_mrc_slabs(tmp_path, monkeypatch):
+    # a few planes per slab
+    monkeypatch.setattr(_writer, 'mrc_slab_size', 3 * 4 * 2)
+    tomo = np.random.random((3, 4, 5))
+    path = write_tomogram(os.path.join(str(tmp_path), "test_tomo"), tomo, {'name': 'test'})
+    with mrcfile.open(path) as mrc:
+        assert mrc.data.dtype == np.float32
+        np.testing.assert_allclose(mrc.data, np.transpose(tomo, (2, 1, 0)).astype(np.float32))
+        np.testing.assert_allclose(mrc.header.dmean, tomo.mean(), rtol=1e-5)
+        np.testing.assert_allclose(mrc.header.rms, tomo.std(), rtol=1e-4)
+    labelmap = np.arange(3 * 4 * 5).reshape((3, 4, 5)) % 7
+    path = write_labelmap(os.path.join(str(tmp_path), "test_labelmap"), labelmap, {'name': 'test'})
+    with mrcfile.open(path) as mrc:
+        assert mrc.data.dtype == np.int8
+        np.testing.assert_array_equal(mrc.data, np.transpose(labelmap, (2, 1, 0)))
+
+
+def test_writing_sparse_labelmap(tmp_path):
+    labelmap = np.zeros((100, 70, 3), dtype=np.int64)
+    labelmap[80:90, 10:20, 1] = 2
+    path = write_labelmap(os.path.join(str(tmp_path), "test_labelmap.npz"), labelmap, {'name': 'test'})
+    labelmap_read, _, layer_type = reader_function(path)[0]
+    assert layer_type == "labels"
+    assert isinstance(labelmap_read, SparseLabelmap)
+    # only the non-background block is stored
+    assert len(labelmap_read._blocks) == 1
+    assert labelmap_read.dtype == np.int8
+    np.testing.assert_array_equal(labelmap_read[80:90, 5:25, 1], labelmap[80:90, 5:25, 1])
+    labelmap_read[0, 0, 0] = 1
+    labelmap[0, 0, 0] = 1
+    np.testing.assert_array_equal(np.asarray(labelmap_read), labelmap)
+
+
+def test_sparse_labelmap_strided_indexing(monkeypatch):
+    dense = np.random.randint(0, 3, (70, 40, 9)).astype(np.int8)
+    dense[:, 20:] = 0
+    labelmap = SparseLabelmap.from_dense(dense, block_shape=(16, 16, 4))
+    for key in [(slice(None, None, 16),) * 3, (slice(3, 60, 7), 5, slice(None, None, -2)),
+                (slice(None), slice(10, 30), 4), (Ellipsis, slice(1, 8, 3)), (slice(60, 3, -5),)]:
+        np.testing.assert_array_equal(labelmap[key], dense[key])
+    # only the stored blocks holding a selected voxel are decompressed, no box is allocated
+    loaded = []
+    load = labelmap._load
+    monkeypatch.setattr(labelmap, '_load', lambda block_index: loaded.append(block_index) or load(block_index))
+    np.testing.assert_array_equal(labelmap[::32, ::32, ::8], dense[::32, ::32, ::8])
+    assert len(loaded) == 3 * 2 * 2
+
+
+def test_annotation_journal(tmp_path):
+    from napari.components import ViewerModel
+    from napari_deepfinder._journal import AnnotationJournal, replay_journal
+    from napari_deepfinder._reader import read_objects
+    path = os.path.join(str(tmp_path), "autosave.xml")
+    viewer = ViewerModel()
+    layer = viewer.add_points(np.array([[1., 2., 3.]]), ndim=3, name='ribosome_1')
+    journal = AnnotationJournal(viewer, path)
+    assert journal.start()
+    layer.add([[4., 5., 6.], [7., 8., 9.]])
+    layer.selected_data = {0}
+    layer.remove_selected()
+    viewer.add_points(np.array([[10., 11., 12.]]), ndim=3, name='proteasome_2')
+    with open(path + '.journal') as f:
+        assert f.read().splitlines() == ['+ 1 4.0 5.0 6.0', '+ 1 7.0 8.0 9.0', '- 1 1.0 2.0 3.0',
+                                         '+ 2 10.0 11.0 12.0']
+    # napari stopped without compacting: the object list is recovered from the journal
+    replay_journal(path)
+    class_labels, coords = read_objects(path)
+    assert np.array_equal(class_labels, [1, 1, 2])
+    assert np.array_equal(coords, [[4, 5, 6], [7, 8, 9], [10, 11, 12]])
+    assert os.path.getsize(path + '.journal') == 0
+    journal.stop()
+    class_labels, coords = read_objects(path)
+    assert np.array_equal(class_labels, [1, 1, 2])
+
+
+def test_annotation_journal_compaction(tmp_path, monkeypatch):
+    from napari.components import ViewerModel
+    from napari_deepfinder import _journal
+    from napari_deepfinder._reader import read_objects
+    monkeypatch.setattr(_journal, 'compaction_interval', 3)
+    path = os.path.join(str(tmp_path), "autosave.xml")
+    viewer = ViewerModel()
+    layer = viewer.add_points(np.array([[1., 2., 3.]]), ndim=3, name='ribosome_1')
+    journal = _journal.AnnotationJournal(viewer, path)
+    assert journal.start()
+    layer.add([[4., 5., 6.]])
+    # moving the points journals "-" then "+" lines, the compaction must not fall in between
+    layer.data = layer.data + 10
+    assert os.path.getsize(path + '.journal') == 0
+    # napari stopped without compacting
+    _journal.replay_journal(path)
+    class_labels, coords = read_objects(path)
+    assert np.array_equal(coords, [[11, 12, 13], [14, 15, 16]])
+    # the object list was replaced atomically, no temporary file is left
+    assert sorted(os.listdir(str(tmp_path))) == ["autosave.xml", "autosave.xml.journal"]
+    journal.stop()
+
+
+def test_saving_atomic_replace(tmp_path, monkeypatch):
+    from napari_deepfinder._background import save_tomogram, save_labelmap, write_and_replace
+    # without a viewer, the layers are saved at once
+    monkeypatch.setattr(napari, 'current_viewer', lambda: None)
+    path = os.path.join(str(tmp_path), "test_tomo.mrc")
+    tomo = np.random.random((20, 10, 5)).astype(np.float32)
+    write_tomogram(path, tomo, {'name': 'test'})
+    # overwrite the file the (memory-mapped) layer data was read from
+    tomo_read = reader_function(path)[0][0]
+    assert isinstance(tomo_read, np.memmap)
+    assert save_tomogram(path, tomo_read * 2, {'name': 'test'}) == path
+    np.testing.assert_array_equal(np.asarray(reader_function(path)[0][0]), tomo * 2)
+    # a zarr folder is replaced as a whole
+    labelmap = np.zeros((20, 10, 5), dtype=np.int8)
+    labelmap_path = save_labelmap(os.path.join(str(tmp_path), "test_labelmap.zarr"), labelmap, {'name': 'test'})
+    labelmap[1, 2, 3] = 4
+    save_labelmap(labelmap_path, labelmap, {'name': 'test'})
+    np.testing.assert_array_equal(np.asarray(reader_function(labelmap_path)[0][0]), labelmap)
+    assert sorted(os.listdir(str(tmp_path))) == ["test_labelmap.zarr", "test_tomo.mrc"]
+    # the progress is reported, and a failed write leaves the previous file
+    percents = []
+    tmp_dir = os.path.join(str(tmp_path), ".tmp")
+    os.mkdir(tmp_dir)
+    write_and_replace(write_tomogram, os.path.join(tmp_dir, "test_tomo.mrc"), path, (tomo, {'name': 'test'}),
+                      percents.append)
+    assert percents[-1] == 100 and percents == sorted(percents)
+    os.mkdir(tmp_dir)
+
+    def failing_write(tmp_file, data, meta):
+        with open(tmp_file, 'w') as f:
+            f.write('partial')
+        raise OSError('No space left on device')
+
+    with pytest.raises(OSError):
+        write_and_replace(failing_write, os.path.join(tmp_dir, "test_tomo.mrc"), path, (tomo, {'name': 'test'}))
+    np.testing.assert_array_equal(np.asarray(reader_function(path)[0][0]), tomo)
+    assert not os.path.exists(tmp_dir)
+
+
+def test_saving_with_viewer(tmp_path, monkeypatch, qtbot):
+    from napari.components import ViewerModel
+    from napari_deepfinder import _background
+    # with a viewer, the layers are saved on a worker thread with a progress bar
+    viewer = ViewerModel()
+    monkeypatch.setattr(napari, 'current_viewer', lambda: viewer)
+    points = [(np.array([[1, 2, 3], [4, 5, 6]]), {'name': 'test_1'}, 'points'),
+              (np.array([[7, 8, 9]]), {'name': 'test_2'}, 'points')]
+    tomo = np.random.random((20, 10, 5)).astype(np.float32)
+    labelmap = np.zeros((20, 10, 5), dtype=np.int8)
+    labelmap[1, 2, 3] = 4
+    paths = [_background.save_annotations_xml(os.path.join(str(tmp_path), "test_objl.xml"), points),
+             _background.save_annotations_npz(os.path.join(str(tmp_path), "test_objl.npz"), points),
+             _background.save_tomogram(os.path.join(str(tmp_path), "test_tomo.mrc"), tomo, {'name': 'test'}),
+             _background.save_labelmap(os.path.join(str(tmp_path), "test_labelmap.npz"), labelmap, {'name': 'test'})]
+    # the temporary folders are removed once every file is written
+    qtbot.waitUntil(lambda: sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(path) for path in paths),
+                    timeout=10000)
+    for path in paths[:2]:
+        layers = reader_function(path)
+        np.testing.assert_array_equal(layers[0][0], points[0][0])
+        np.testing.assert_array_equal(layers[1][0], points[1][0])
+    np.testing.assert_array_equal(np.asarray(reader_function(paths[2])[0][0]), tomo)
+    np.testing.assert_array_equal(np.asarray(reader_function(paths[3])[0][0]), labelmap)
+
+
+def test_saving_snapshots(tmp_path, monkeypatch):
+    from napari_deepfinder import _background
+    monkeypatch.setattr(napari, 'current_viewer', lambda: None)
+    # every layer is snapshotted to a temporary file of its own
+    monkeypatch.setattr(_background, 'max_snapshot_bytes', 0)
+    points = [(np.array([[1., 2, 3], [4, 5, 6]]), {'name': 'test_1'}, 'points'),
+              (np.array([[7., 8, 9]]), {'name': 'test_2'}, 'points')]
+    path = _background.save_annotations_npz(os.path.join(str(tmp_path), "test_objl.npz"), points)
+    layers = reader_function(path)
+    np.testing.assert_array_equal(layers[0][0], points[0][0])
+    np.testing.assert_array_equal(layers[1][0], points[1][0])
+    assert os.listdir(str(tmp_path)) == ["test_objl.npz"]
+
+
+def test_saving_multiscale(tmp_path, monkeypatch):
+    from napari_deepfinder._background import save_labelmap, save_tomogram
+    from napari_deepfinder._cache import data_nbytes
+    monkeypatch.setattr(napari, 'current_viewer', lambda: None)
+    tomo = np.random.random((20, 10, 6)).astype(np.float32)
+    labelmap = np.zeros((20, 10, 6), dtype=np.int8)
+    labelmap[1, 2, 3] = 4
+    # napari wraps multiscale data in a MultiScaleData, which is neither a list nor a tuple
+    image_layer = napari.layers.Image([tomo, tomo[::2, ::2, ::2]], multiscale=True)
+    labels_layer = napari.layers.Labels([labelmap, labelmap[::2, ::2, ::2]], multiscale=True)
+    assert data_nbytes(image_layer.data) == tomo.nbytes + tomo[::2, ::2, ::2].nbytes
+    # the full resolution is saved
+    path = save_tomogram(os.path.join(str(tmp_path), "test_tomo.mrc"), image_layer.data, {'name': 'test'})
+    np.testing.assert_array_equal(np.asarray(reader_function(path)[0][0]), tomo)
+    path = save_labelmap(os.path.join(str(tmp_path), "test_labelmap.npz"), labels_layer.data, {'name': 'test'})
+    np.testing.assert_array_equal(np.asarray(reader_function(path)[0][0]), labelmap)
@@ -1,19 +1,29 @@
 import numpy as np
 from magicgui import magic_factory
-from qtpy.QtWidgets import QWidget, QGridLayout, QComboBox, QPushButton, QLabel, QPlainTextEdit, QGroupBox
+from qtpy.QtWidgets import QWidget, QGridLayout, QComboBox, QPushButton, QLabel, QPlainTextEdit, QGroupBox, \
+    QLineEdit, QCheckBox, QFileDialog, QDoubleSpinBox, QSpinBox
 from qtpy import QtCore
 import napari
 import napari.layers
-from scipy.ndimage import uniform_filter
 import warnings
+from functools import partial
+from napari.qt.threading import create_worker
+from ._denoise import denoise_dtypes, denoise_engines, denoise_preview, iter_denoise
+from ._journal import AnnotationJournal
+from ._layer_model import LayerComboBox
+from ._points_index import points_index
+from ._snap import snap_extrema, snap_to_extremum
 
 
-@magic_factory(auto_call=True)
+@magic_factory(auto_call=True, engine={'choices': denoise_engines}, output_dtype={'choices': denoise_dtypes})
 def denoise_widget(
         viewer: 'napari.viewer.Viewer',
         image_layer: 'napari.layers.Image',
         filter_size: int = 3,
         activate_denoise=False,
+        engine: str = 'exact',
+        preview=False,
+        output_dtype: str = 'same',
 ):
     """
     Widget to denoise an image layer.
@@ -24,67 +34,137 @@ def denoise_widget(
     viewer : napari.viewer.Viewer
     image_layer: napari.layers.Image
     filter_size: int
+        Size of the mean filter, or cutoff wavelength (in voxels) of the low-pass filters
     activate_denoise: bool
+    engine: str
+        'exact' (same result as scipy's uniform_filter) or 'summed volume table'
+        (the table of the image is computed once, then each filter size is fast)
+        mean filters, or 'gaussian low-pass (fft)' or 'butterworth low-pass (fft)'
+        (the spectrum of the image is computed once, then each cutoff is fast)
+    preview: bool
+        Only denoise the displayed slices, when they are displayed. The whole
+        volume is denoised with the engine when preview is unchecked.
+    output_dtype: str
+        dtype of the denoised image: 'same' as the image, 'float32' or 'float16' (half the memory)
+
+    The volume is denoised in a background worker, changing the parameters
+    cancels it, and the denoised layer is updated with the newest result only.
+    Volumes too large for the memory budget are denoised by chunks (see _denoise.iter_denoise).
     """
     # Initialisation
     if not hasattr(denoise_widget, 'denoised_layer'):
         # persistant values initialisation
         denoise_widget.denoised_layer = None
         denoise_widget.original_layer = None
-        denoise_widget.old_filter_size = filter_size
+        # denoising runs in a worker, numbered to only display the result of the newest job
+        denoise_widget.worker = None
+        denoise_widget.job = 0
+        denoise_widget.job_params = None
     if image_layer is None:
         denoise_widget.activate_denoise.value = False
         denoise_widget.activate_denoise.enabled = False
     else:
         if not denoise_widget.activate_denoise.get_value():
             denoise_widget.activate_denoise.enabled = True
-        denoised_name = image_layer.name + '_denoised'
-        if denoise_widget.denoised_layer is None:
-            denoised_im = False
-        else:
-            denoised_im = True
-        if activate_denoise and denoised_im is False:
-            denoised_data = uniform_filter(image_layer.data, size=filter_size)
-            denoise_widget.old_filter_size = filter_size
-            # correctly insert layer
-            denoised_im = napari.layers.Layer.create(denoised_data, {'name': denoised_name}, layer_type='image')
-            insert_index = index_of_layer(viewer, image_layer) + 1
-            viewer.layers.insert(insert_index, denoised_im)
-            # store denoised and original layers persistently
-            denoise_widget.denoised_layer = viewer.layers[insert_index]
-            denoise_widget.original_layer = viewer.layers[image_layer.name]
-            # raise warning to the user, that this name has already been taken
-            real_name = denoise_widget.denoised_layer.name
-            if denoised_name != real_name:
-                for layer in viewer.layers:
-                    if layer.name == denoised_name:
-                        warnings.warn('Name %s already taken, so %s chosen' % (denoised_name, real_name))
-            # dummy is a workaround, because of a bug in layers
-            dummy = napari.layers.Layer.create(np.zeros((1, 1, 1)), {'name': 'dummy'}, layer_type='image')
-            viewer.layers.insert(0, dummy)
-            viewer.layers.remove(viewer.layers['dummy'])
-            # correctly hide original image
-            viewer.layers[image_layer.name].visible = False
-            # correctly lock the image layer selector when denoising applied
+        params = (filter_size, engine, preview, output_dtype)
+        if activate_denoise and denoise_widget.job_params != params:
+            dtype = np.dtype(image_layer.dtype if output_dtype == 'same' else output_dtype)
+            previous = None if denoise_widget.denoised_layer is None else denoise_widget.denoised_layer.data
+            output = None
+            if denoise_widget.worker is None and isinstance(previous, np.ndarray) and previous.flags.writeable \
+                    and previous.shape == image_layer.data.shape and previous.dtype == dtype:
+                # overwrite the previous result instead of allocating a new volume (it is no more
+                # written by a running job): the denoised layer is updated progressively
+                output = previous
+            # the parameters changed: cancel the running job, its result is outdated
+            cancel_denoise_job(denoise_widget)
+            denoise_widget.job_params = params
+            # lock the image layer selector while denoising is applied
             denoise_widget.image_layer.enabled = False
-        elif activate_denoise and denoise_widget.old_filter_size != filter_size and denoised_im is True:
-            denoise_widget.denoised_layer.data = uniform_filter(image_layer.data, size=filter_size)
-            denoise_widget.denoised_layer.reset_contrast_limits()
-            denoise_widget.old_filter_size = filter_size
-        elif denoised_im and not activate_denoise:
-            if index_of_layer(viewer, denoise_widget.denoised_layer) is False:
-                if index_of_layer(viewer, denoise_widget.original_layer) is not False:
-                    viewer.layers[denoise_widget.original_layer.name].visible = True
+            if preview:
+                # lazy, computed when displayed
+                show_denoised(denoise_widget, viewer, image_layer, preview, denoise_widget.job,
+                              denoise_preview(image_layer.data, filter_size, engine, dtype))
             else:
-                if index_of_layer(viewer, denoise_widget.original_layer) is not False:
-                    viewer.layers[denoise_widget.original_layer.name].visible = True
-                    viewer.layers.remove(viewer.layers[denoise_widget.denoised_layer.name])
+                worker = create_worker(iter_denoise, image_layer, filter_size, engine, dtype, output)
+                # denoise_widget only refers to the widget during its calls, so the widget is bound
+                worker.returned.connect(partial(show_denoised, denoise_widget, viewer, image_layer, preview,
+                                                denoise_widget.job))
+                denoise_widget.worker = worker
+                worker.start()
+        elif not activate_denoise and denoise_widget.job_params is not None:
+            cancel_denoise_job(denoise_widget)
+            denoise_widget.job_params = None
+            if denoise_widget.denoised_layer is not None:
+                if index_of_layer(viewer, denoise_widget.denoised_layer) is False:
+                    if index_of_layer(viewer, denoise_widget.original_layer) is not False:
+                        viewer.layers[denoise_widget.original_layer.name].visible = True
+                else:
+                    if index_of_layer(viewer, denoise_widget.original_layer) is not False:
+                        viewer.layers[denoise_widget.original_layer.name].visible = True
+                        viewer.layers.remove(viewer.layers[denoise_widget.denoised_layer.name])
             # return to init state
             denoise_widget.image_layer.enabled = True
             denoise_widget.denoised_layer = None
             denoise_widget.original_layer = None
 
 
+def cancel_denoise_job(widget):
+    """Cancel the running denoising job of the denoise widget, if any, and discard its result"""
+    if widget.worker is not None:
+        # the generator worker stops at its next step
+        widget.worker.quit()
+        widget.worker = None
+    widget.job += 1
+
+
+def show_denoised(widget, viewer, image_layer, preview, job, denoised_data):
+    """Display the result of a denoising job in the denoised layer, inserting it if needed"""
+    if job != widget.job:
+        # a newer job was started
+        return
+    widget.worker = None
+    if widget.denoised_layer is not None and widget.denoised_layer.multiscale != isinstance(denoised_data, list):
+        # napari cannot switch a layer between single and multiscale data (the preview of a multiscale
+        # image is multiscale, its denoised volume is not), the layer is inserted again
+        if index_of_layer(viewer, widget.denoised_layer) is not False:
+            viewer.layers.remove(widget.denoised_layer)
+        widget.denoised_layer = None
+    if widget.denoised_layer is not None:
+        widget.denoised_layer.data = denoised_data
+        if preview:
+            # computing the contrast limits would denoise the whole volume
+            widget.denoised_layer.contrast_limits = image_layer.contrast_limits
+        else:
+            widget.denoised_layer.reset_contrast_limits()
+        return
+    denoised_name = image_layer.name + '_denoised'
+    # correctly insert layer
+    add_kwargs = {'name': denoised_name}
+    if preview:
+        add_kwargs['contrast_limits'] = image_layer.contrast_limits
+    if isinstance(denoised_data, list):
+        add_kwargs['multiscale'] = True
+    denoised_im = napari.layers.Layer.create(denoised_data, add_kwargs, layer_type='image')
+    insert_index = index_of_layer(viewer, image_layer) + 1
+    viewer.layers.insert(insert_index, denoised_im)
+    # store denoised and original layers persistently
+    widget.denoised_layer = viewer.layers[insert_index]
+    widget.original_layer = viewer.layers[image_layer.name]
+    # raise warning to the user, that this name has already been taken
+    real_name = widget.denoised_layer.name
+    if denoised_name != real_name:
+        for layer in viewer.layers:
+            if layer.name == denoised_name:
+                warnings.warn('Name %s already taken, so %s chosen' % (denoised_name, real_name))
+    # dummy is a workaround, because of a bug in layers
+    dummy = napari.layers.Layer.create(np.zeros((1, 1, 1)), {'name': 'dummy'}, layer_type='image')
+    viewer.layers.insert(0, dummy)
+    viewer.layers.remove(viewer.layers['dummy'])
+    # correctly hide original image
+    viewer.layers[image_layer.name].visible = False
+
+
 @magic_factory(auto_call=True, call_button="Reorder layers")
 def reorder_widget(viewer: 'napari.viewer.Viewer'):
     """
@@ -110,9 +190,6 @@ class AddPointsWidget(QWidget):
         super().__init__()
         self.viewer = napari_viewer
 
-        # Use this event because of bug in viewer.events.layers_change.connect() : it doesn't register name change
-        napari_viewer.layers.events.connect(self._on_layer_change)
-
         self.setLayout(QGridLayout())
         # Info box for annotation
         self.group_info = QGroupBox('Information')
@@ -127,54 +204,142 @@ class AddPointsWidget(QWidget):
         self.group_info.setLayout(self.box_info)
         self.layout().addWidget(self.group_info, 0, 0, 1, 3)
         # Add points
-        self._input_layer_box = QComboBox()
+        self._input_layer_box = LayerComboBox(napari_viewer, napari.layers.Points)
         self._add_point = QPushButton("Add point")
         self._add_point.clicked.connect(self._run)
         self.layout().addWidget(QLabel('Points layer:'), 1, 0, 1, 1)
         self.layout().addWidget(self._input_layer_box, 1, 1, 1, 2)
-        self.layout().addWidget(self._add_point, 2, 0, 1, 3)
+        # A warning is shown for points added closer than this to a point of the layer (0 to disable)
+        self.duplicate_radius = QDoubleSpinBox()
+        self.duplicate_radius.setValue(2)
+        self.layout().addWidget(QLabel('Duplicate radius:'), 2, 0, 1, 1)
+        self.layout().addWidget(self.duplicate_radius, 2, 1, 1, 2)
+        self._select_nearest = QPushButton("Select nearest point")
+        self._select_nearest.clicked.connect(self.select_nearest)
+        self.layout().addWidget(self._add_point, 3, 0, 1, 2)
+        self.layout().addWidget(self._select_nearest, 3, 2, 1, 1)
+        # Refinement of the added points to the darkest (or brightest) voxel around them
+        self.group_snap = QGroupBox('Snap to local extremum')
+        self.group_snap.setCheckable(True)
+        self.group_snap.setChecked(False)
+        self.box_snap = QGridLayout()
+        self._snap_layer_box = LayerComboBox(napari_viewer, napari.layers.Image)
+        self.box_snap.addWidget(QLabel('Image layer:'), 0, 0, QtCore.Qt.AlignTop)
+        self.box_snap.addWidget(self._snap_layer_box, 0, 1, 1, 2, QtCore.Qt.AlignTop)
+        self.snap_extremum = QComboBox()
+        self.snap_extremum.addItems(snap_extrema)
+        self.box_snap.addWidget(QLabel('Extremum:'), 1, 0, QtCore.Qt.AlignTop)
+        self.box_snap.addWidget(self.snap_extremum, 1, 1, 1, 2, QtCore.Qt.AlignTop)
+        self.snap_radius = QSpinBox()
+        self.snap_radius.setValue(3)
+        self.box_snap.addWidget(QLabel('Radius:'), 2, 0, QtCore.Qt.AlignTop)
+        self.box_snap.addWidget(self.snap_radius, 2, 1, 1, 2, QtCore.Qt.AlignTop)
+        # a box filter on the window, for noisy tomograms that were not denoised
+        self.snap_filter_size = QSpinBox()
+        self.snap_filter_size.setMinimum(1)
+        self.snap_filter_size.setValue(1)
+        self.box_snap.addWidget(QLabel('Filter size:'), 3, 0, QtCore.Qt.AlignTop)
+        self.box_snap.addWidget(self.snap_filter_size, 3, 1, 1, 2, QtCore.Qt.AlignTop)
+        self.group_snap.setLayout(self.box_snap)
+        self.layout().addWidget(self.group_snap, 4, 0, 1, 3)
+        # Autosave of the annotations, journaled to avoid rewriting the whole object list
+        self.journal = None
+        self.group_autosave = QGroupBox('Autosave')
+        self.box_autosave = QGridLayout()
+        self.box_autosave.addWidget(QLabel('Object list path:'), 0, 0, QtCore.Qt.AlignTop)
+        self.autosave_path = QLineEdit()
+        self.box_autosave.addWidget(self.autosave_path, 0, 1, 1, 2, QtCore.Qt.AlignTop)
+        browse_btn_p = QPushButton('...')
+        browse_btn_p.released.connect(self.browse_autosave)
+        self.box_autosave.addWidget(browse_btn_p, 0, 3, 1, 1, QtCore.Qt.AlignTop)
+        self.autosave = QCheckBox("Autosave")
+        self.autosave.toggled.connect(self._on_autosave)
+        self.box_autosave.addWidget(self.autosave, 1, 0, 1, 4, QtCore.Qt.AlignTop)
+        self.group_autosave.setLayout(self.box_autosave)
+        self.layout().addWidget(self.group_autosave, 5, 0, 1, 3)
         self.layout().addWidget(QWidget(), 1, QtCore.Qt.AlignTop)
-        self._on_layer_change()
-
-    def _on_layer_change(self, event=None):
-        current_text = self._input_layer_box.currentText()
-        self._input_layer_box.clear()
-        is_current_item_still_here = False
-        for layer in self.viewer.layers:
-            if isinstance(layer, napari.layers.points.points.Points):
-                if layer.name == current_text:
-                    is_current_item_still_here = True
-                self._input_layer_box.addItem(layer.name)
-        if is_current_item_still_here:
-            self._input_layer_box.setCurrentText(current_text)
+
+    def browse_autosave(self):
+        """Callback called when the browse autosave button is clicked"""
+        file = QFileDialog.getSaveFileName(self, "Save file", "", "*.xml")
+        if file[0] != "":
+            if file[0][-4:] == '.xml':
+                self.autosave_path.setText(file[0])
+            else:
+                self.autosave_path.setText(file[0]+'.xml')
         else:
-            self._input_layer_box.setCurrentIndex(-1)
+            print("No file selected")
+
+    def _on_autosave(self, checked):
+        if checked:
+            if self.autosave_path.text() == "":
+                self.autosave.setChecked(False)
+                return
+            self.journal = AnnotationJournal(self.viewer, self.autosave_path.text())
+            if self.journal.start():
+                self.autosave_path.setEnabled(False)
+            else:
+                # unsaved annotations of a previous session were recovered in the object list
+                self.journal = None
+                self.autosave.setChecked(False)
+        elif self.journal is not None:
+            self.journal.stop()
+            self.journal = None
+            self.autosave_path.setEnabled(True)
 
     def _run(self):
-        # save against edge cases where the name of the layer is modified and the add button is clicked just after
-        old_text = self._input_layer_box.currentText()
-        self._on_layer_change()
-        current_layer_text = self._input_layer_box.currentText()
-        if current_layer_text is not None and current_layer_text != "" and old_text == current_layer_text:
-            layer = self.viewer.layers[current_layer_text]
-            layer.add(self.viewer.dims.current_step)
+        layer = self._input_layer_box.current_layer()
+        if layer is not None:
+            # world position of the viewer (dims.current_step is an index in the dims range)
+            position = np.asarray(self.viewer.dims.point, dtype=np.float64)
+            image_layer = self._snap_layer_box.current_layer()
+            if self.group_snap.isChecked() and image_layer is not None:
+                snapped = snap_to_extremum(image_layer.data, image_layer.world_to_data(position),
+                                           self.snap_radius.value(), self.snap_extremum.currentText(),
+                                           self.snap_filter_size.value())
+                position = np.asarray(image_layer.data_to_world(snapped), dtype=np.float64)
+            point = np.asarray(layer.world_to_data(position), dtype=np.float64)
+            distance = self.find_duplicate(layer, point)
+            if distance is not None:
+                warnings.warn('A point of layer %s is already at a distance of %.1f' % (layer.name, distance))
+            layer.add(point)
+
+    def find_duplicate(self, layer, point):
+        """Distance of the nearest point of layer if it is within the duplicate radius of point, else None"""
+        radius = self.duplicate_radius.value()
+        if radius <= 0 or layer.ndim != len(point):
+            return None
+        _, distance = points_index(layer).nearest(point)
+        return distance if distance <= radius else None
+
+    def select_nearest(self):
+        """Select the point of the points layer that is the nearest to the current position"""
+        layer = self._input_layer_box.current_layer()
+        if layer is not None:
+            index, _ = points_index(layer).nearest(layer.world_to_data(self.viewer.dims.point))
+            if index is not None:
+                self.viewer.layers.selection.active = layer
+                layer.selected_data = {index}
 
 
 def reorder(viewer):
-    new_list = viewer.layers
-    old_list = new_list.copy()
-    old_order = [check_instance(i) for i in old_list]
-    while sorted(old_order) != old_order:
-        new_list = viewer.layers
-        old_list = new_list.copy()
-        old_order = [check_instance(i) for i in old_list]
-        old_index = [i for i in range(len(old_order))]
-        zipped_old = zip(old_order, old_index)
-        zipped_new = sorted(zipped_old)
-        for i, (order, index) in enumerate(zipped_new):
-            if index != i:
-                new_list.move(index, i)
-                break
+    """Sort the layers by type (see check_instance) in a single batched reordering.
+
+    The sorted order is computed at once (stable, so that layers of the same
+    type keep their relative order), then each layer is moved straight to its
+    place. The reordered event is emitted once at the end instead of once per
+    move, the moved events are kept for the layer list view.
+    """
+    layers = viewer.layers
+    sorted_layers = sorted(layers, key=check_instance)
+    if sorted_layers == list(layers):
+        return
+    with layers.events.reordered.blocker():
+        for index, layer in enumerate(sorted_layers):
+            current_index = layers.index(layer)
+            if current_index != index:
+                layers.move(current_index, index)
+    layers.events.reordered(value=layers)
 
 
 def check_instance(layer_object):
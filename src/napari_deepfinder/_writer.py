@@ -1,59 +1,187 @@
 from __future__ import annotations
-import napari.layers
 import numpy
-import pandas as pd
-from lxml import etree
+from pathlib import Path
 import re
+import dask.array as da
+import mrcfile
 import numpy as np
-from deepfinder.utils import common as cm
-
-
-def write_annotations_xml(path: str, data: list):
+import zarr
+from mrcfile.utils import mode_from_dtype
+from ._sparse import SparseLabelmap, save_sparse_labelmap
+
+# chunk size of the written Zarr arrays, along each axis
+zarr_chunk_size = 64
+# number of voxels converted at once when writing mrc files
+mrc_slab_size = 32 * 1024 ** 2
+# number of objects formatted at once when writing xml object lists
+xml_chunk_size = 65536
+# OME-Zarr 0.4 images are Zarr v2 stores: zarr-python 3 creates v3 stores by
+# default, while zarr-python 2 (the last one supporting Python < 3.11) only
+# writes v2 stores and has no zarr_format argument
+zarr_format_kwargs = {'zarr_format': 2} if int(zarr.__version__.split('.')[0]) >= 3 else {}
+
+
+def write_annotations_xml(path: str, data: list, progress=None):
     """Writer for annotations in for of a xml object list"""
-    layers_df_list = []
-    class_numbers = []
-    for layer in data:
-        layer_df = points_layer_to_df(layer[0])
-        layers_df_list.append(layer_df)
-        class_number = layer_order(layer)
-        class_numbers.append(class_number)
-    sorted_layer_list, sorted_class_numbers = sort_layers(layers_df_list, class_numbers)
-    final_df = layers_df_list_to_final_df(sorted_layer_list, sorted_class_numbers)
-    if path[-4:] == '.xml':
-        write_xml(final_df, path)
-        return path
-    else:
+    class_numbers = [layer_order(layer) for layer in data]
+    sorted_points, sorted_class_numbers = sort_layers([layer[0] for layer in data], class_numbers)
+    if path[-4:] != '.xml':
         path += '.xml'
-        write_xml(final_df, path)
-        return path
-
-
-def write_labelmap(path: str, data: numpy.array, meta: dict):
+    write_objects_xml(path, sorted_points, sorted_class_numbers, progress)
+    return path
+
+
+def write_annotations_npz(path: str, data: list, progress=None):
+    """Writer for annotations in form of a binary columnar object list (.npz)
+
+    The archive holds the columns 'tomo_idx' and 'class_label' of shape (n,),
+    and 'coords' of shape (n, 3) whose columns are x, y and z. The objects are
+    sorted by class, so that each class is read back as a view of 'coords'.
+    The archive is written at once, progress, if given, is called with 1.0
+    once it is complete.
+    """
+    class_numbers = [layer_order(layer) for layer in data]
+    sorted_layers, sorted_class_numbers = sort_layers(data, class_numbers)
+    coords = [np.asarray(layer[0], dtype=np.float64).reshape(-1, 3) for layer in sorted_layers]
+    sizes = [len(points) for points in coords]
+    tomo_idx = []
+    for layer, size in zip(sorted_layers, sizes):
+        features = layer[1].get('features')
+        if features is not None and 'tomo_idx' in features:
+            tomo_idx.append(np.asarray(features['tomo_idx'], dtype=np.int32))
+        else:
+            tomo_idx.append(np.full(size, -1, dtype=np.int32))
+    if path[-4:] != '.npz':
+        path += '.npz'
+    np.savez(path,
+             tomo_idx=np.concatenate(tomo_idx) if tomo_idx else np.empty(0, dtype=np.int32),
+             class_label=np.repeat(np.array(sorted_class_numbers, dtype=np.int32), sizes),
+             coords=np.concatenate(coords) if coords else np.empty((0, 3)))
+    if progress is not None:
+        progress(1.0)
+    return path
+
+
+def write_labelmap(path: str, data: numpy.array, meta: dict, progress=None):
     """Writer for labelmaps (segmentation maps)"""
-    array_label = np.transpose(data, (2, 1, 0))
     type_list = ['int8', 'int16', 'uint8', 'uint16']
-    # If the labelmap array is not in a correct type, cast to int8
-    if array_label.dtype not in type_list:
-        array_label = array_label.astype('int8')
-    if path[-4:] == '.mrc':
-        cm.write_array(array_label, path)
+    # If the labelmap array is not in a correct type, cast to int8 (slab by slab when writing)
+    dtype = data.dtype if data.dtype in type_list else np.dtype('int8')
+    if path.endswith('.zarr'):
+        write_zarr(data, path, dtype, progress)
         return path
-    else:
-        path += '.mrc'
-        cm.write_array(array_label, path)
+    if path.endswith('.npz'):
+        # compressed blocks, background blocks are not stored
+        if not isinstance(data, SparseLabelmap) or data.dtype != dtype:
+            data = SparseLabelmap.from_dense(data if data.dtype == dtype else LazyAstype(data, dtype))
+        save_sparse_labelmap(data, path)
         return path
+    if path[-4:] != '.mrc':
+        path += '.mrc'
+    write_mrc(data, path, dtype, progress)
+    return path
 
 
-def write_tomogram(path: str, data: numpy.array, meta: dict):
+def write_tomogram(path: str, data: numpy.array, meta: dict, progress=None):
     """Writer for tomograms"""
-    array_tomo = np.transpose(data, (2, 1, 0))
-    if path[-4:] == '.mrc':
-        cm.write_array(array_tomo, path)
+    if path.endswith('.zarr'):
+        write_zarr(data, path, progress=progress)
         return path
-    else:
+    if path[-4:] != '.mrc':
         path += '.mrc'
-        cm.write_array(array_tomo, path)
-        return path
+    write_mrc(data, path, mrc_dtype(data.dtype), progress)
+    return path
+
+
+def write_mrc(data, path: str, dtype=None, progress=None):
+    """Write a x,y,z volume to a mrc file (z,y,x on disk), slab by slab.
+
+    The file is memory-mapped and filled one z slab of about mrc_slab_size
+    voxels at a time: the axes are reordered and the dtype converted per slab,
+    so the memory used does not depend on the size of the volume. The header
+    statistics are accumulated over the slabs. progress, if given, is called
+    with the fraction of the volume written after each slab.
+    """
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+    shape = data.shape[::-1]
+    step = max(mrc_slab_size // max(shape[1] * shape[2], 1), 1)
+    dmin, dmax, total, total_sq = np.inf, -np.inf, 0., 0.
+    with mrcfile.new_mmap(path, shape=shape, mrc_mode=mode_from_dtype(dtype), overwrite=True) as mrc:
+        for start in range(0, shape[0], step):
+            stop = min(start + step, shape[0])
+            slab = np.asarray(data[:, :, start:stop])
+            # invert axes from x,y,z to z,y,x (weird convention)
+            mrc.data[start:stop] = np.transpose(slab, (2, 1, 0)).astype(dtype, copy=False)
+            stored = mrc.data[start:stop]
+            dmin = min(dmin, stored.min())
+            dmax = max(dmax, stored.max())
+            total += stored.sum(dtype=np.float64)
+            total_sq += np.square(stored, dtype=np.float64).sum()
+            if progress is not None:
+                progress(stop / shape[0])
+        if data.size > 0:
+            mean = total / data.size
+            mrc.header.dmin = np.float32(dmin)
+            mrc.header.dmax = np.float32(dmax)
+            mrc.header.dmean = np.float32(mean)
+            mrc.header.rms = np.float32(np.sqrt(max(total_sq / data.size - mean ** 2, 0)))
+        else:
+            mrc.reset_header_stats()
+
+
+class LazyAstype:
+    """Array-like converting the regions of an array to dtype when they are indexed"""
+
+    def __init__(self, data, dtype):
+        self.data = data
+        self.dtype = np.dtype(dtype)
+        self.shape = data.shape
+
+    def __getitem__(self, key):
+        return np.asarray(self.data[key]).astype(self.dtype)
+
+
+def mrc_dtype(dtype):
+    """dtype in which an array is stored in a mrc file, float32 if its own dtype has no mrc mode"""
+    try:
+        mode_from_dtype(np.dtype(dtype))
+        return np.dtype(dtype)
+    except ValueError:
+        return np.dtype(np.float32)
+
+
+def write_zarr(data, path: str, dtype=None, progress=None):
+    """Write a x,y,z volume as a chunked and compressed OME-Zarr image (z,y,x on disk).
+
+    The chunks are compressed with the default Zarr compressor and written in
+    parallel by the dask threaded scheduler, each task writing whole chunks.
+    The axes are reordered and the volume converted to dtype chunk by chunk.
+    progress, if given, is called with the fraction of the volume written after
+    each z slab of chunks.
+    """
+    chunks = tuple(min(zarr_chunk_size, n) for n in data.shape[::-1])
+    # invert axes from x,y,z to z,y,x (weird convention)
+    source = da.transpose(da.from_array(data, chunks=chunks[::-1]), (2, 1, 0))
+    if dtype is not None:
+        source = source.astype(dtype)
+    root = zarr.open_group(path, mode='w', **zarr_format_kwargs)
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': Path(path).stem,
+        'axes': [{'name': axis, 'type': 'space'} for axis in 'zyx'],
+        'datasets': [{'path': '0',
+                      'coordinateTransformations': [{'type': 'scale', 'scale': [1.0, 1.0, 1.0]}]}],
+    }]
+    target = zarr.open_array(store=path, path='0', mode='w', shape=source.shape,
+                             chunks=chunks, dtype=source.dtype, **zarr_format_kwargs)
+    # chunks of source and target are aligned, so no lock is needed
+    if progress is None:
+        da.store(source, target, lock=False)
+        return
+    for start in range(0, source.shape[0], chunks[0]):
+        region = slice(start, start + chunks[0])
+        da.store(source[region], target, regions=(region,), lock=False)
+        progress(min(start + chunks[0], source.shape[0]) / source.shape[0])
 
 
 def layer_order(layer):
@@ -79,37 +207,40 @@ def sort_layers(layers_df_list: list, class_numbers: list):
     return sorted_layer_list, sorted_class_numbers
 
 
-def points_layer_to_df(layer: napari.layers.Layer):
-    layer_df = pd.DataFrame(layer, columns=['x', 'y', 'z'])
-    return layer_df
-
-
-def layers_df_list_to_final_df(layers_df_list: list, class_numbers: list):
-    final_list = []
-    for i, dataframe in enumerate(layers_df_list):
-        # there seems to be a bug in Napari, where a duplicated layer might be the ~same df object
-        df = dataframe.copy(deep=True)
-        class_label = class_numbers[i]
-        df.insert(loc=0, column='tomo_idx', value='')
-        df.insert(loc=1, column='class_label', value=class_label)
-        final_list.append(df)
-    return pd.concat(final_list, ignore_index=True)
-
-
-def write_xml(df: pd.DataFrame, filename: str):
-    objl_xml = etree.Element('objlist')
-    for idx in df.index:
-        tidx = df.loc[idx, 'tomo_idx']
-        lbl = df.loc[idx, 'class_label']
-        x = df.loc[idx, 'x']
-        y = df.loc[idx, 'y']
-        z = df.loc[idx, 'z']
-        obj = etree.SubElement(objl_xml, 'object')
-        if tidx is not None:
-            obj.set('tomo_idx', str(tidx))
-        obj.set('class_label', str(lbl))
-        obj.set('x', '%i' % x)
-        obj.set('y', '%i' % y)
-        obj.set('z', '%i' % z)
-    tree = etree.ElementTree(objl_xml)
-    tree.write(filename, pretty_print=True)
+def write_objects_xml(filename: str, points_list: list, class_numbers: list, progress=None):
+    """Stream points arrays to a xml object list.
+
+    The objects are formatted by chunks of xml_chunk_size points, with a single
+    string formatting operation per chunk, and written to disk chunk by chunk.
+    Each object is a line <object tomo_idx="" class_label=... x=... y=... z=.../>
+    with coordinates truncated to integers.
+
+    Parameters
+    ----------
+    filename : str
+    points_list : list of numpy.ndarray
+        x, y, z coordinates of the points of each class, of shape (n, 3).
+    class_numbers : list of int
+        Class label of each points array.
+    progress : callable, optional
+        Called with the fraction of the objects written after each chunk.
+    """
+    n_objects = sum(len(points) for points in points_list)
+    n_written = 0
+    with open(filename, 'w', encoding='ascii') as f:
+        if n_objects == 0:
+            f.write('<objlist/>\n')
+            return
+        f.write('<objlist>\n')
+        for points, class_label in zip(points_list, class_numbers):
+            line = '  <object tomo_idx="" class_label="%s" x="%%i" y="%%i" z="%%i"/>\n' % class_label
+            points = np.asarray(points)
+            for start in range(0, len(points), xml_chunk_size):
+                # truncate the coordinates to integers
+                chunk = points[start:start + xml_chunk_size].astype(np.int64)
+                f.write((line * len(chunk)) % tuple(chunk.ravel().tolist()))
+                n_written += len(chunk)
+                if progress is not None:
+                    progress(n_written / n_objects)
+        f.write('</objlist>\n')
+